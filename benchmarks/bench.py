@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+#
+# supcut - Simple Unobtrusive Python Contituous Unit Testing
+#
+# Copyright (C) 2010 Federico Ceratto
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark supcut's hot paths on synthetic nose outputs and inotify
+event storms. Each case runs in a forked process to measure its peak
+memory in isolation.
+
+Usage: python benchmarks/bench.py [--quick] [case name prefix ...]
+"""
+
+import json
+import os
+from os.path import abspath, dirname, join
+from optparse import OptionParser
+import random
+import resource
+import shutil
+import sys
+import tempfile
+from threading import Lock
+from time import time
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), 'supcut'))
+
+import supcut as core
+from archive import Archive
+from noseoutput import NoseOutputParser
+from scheduler import Scheduler
+from xunit import parse_xunit
+
+SIZES = [(10, 1), (1000, 1), (1000, 100), (100000, 1), (100000, 1000)]
+QUICK_SIZES = [(10, 1), (1000, 100)]
+EVENTS = [1000, 100000]
+QUICK_EVENTS = [1000]
+
+
+# synthetic data
+
+def nose_output(tests, failures, trace_lines=10, log_lines=20, pkg='pkg'):
+    """Generate the text output of a nosetests run, the failing tests
+    belonging to the pkg package"""
+    out = ['.' * (tests - failures) + 'F' * failures]
+    for i in xrange(failures):
+        out.extend([
+            '=' * 70,
+            'FAIL: test_%d (%s.test_mod%d.TestCase)' % (i, pkg, i % 50),
+            '-' * 70,
+            'Traceback (most recent call last):',
+        ])
+        for n in xrange(trace_lines):
+            out.append('  File "/src/pkg/mod%d.py", line %d, in f%d' % (
+                n, n * 10, n))
+            out.append('    do_something(%d)' % n)
+        out.append('AssertionError: %d != %d' % (i, i + 1))
+        out.append('-------------------- >> begin captured logging '
+            '<< --------------------')
+        for n in xrange(log_lines):
+            out.append('pkg.mod: DEBUG: log line %d of test %d' % (n, i))
+        out.append('--------------------- >> end captured logging '
+            '<< ---------------------')
+        out.append('')
+    out.extend([
+        '-' * 70,
+        'Ran %d tests in 12.345s' % tests,
+        '',
+        'FAILED (failures=%d)' % failures if failures else 'OK',
+    ])
+    return '\n'.join(out) + '\n'
+
+
+def xunit_output(tests, failures, trace_lines=10):
+    """Generate a nose xunit report"""
+    out = ['<?xml version="1.0" encoding="UTF-8"?>',
+        '<testsuite name="nosetests" tests="%d" errors="0" failures="%d" '
+        'skip="0">' % (tests, failures)]
+    trace = '\n'.join('  File "/src/pkg/mod%d.py", line %d' % (n, n)
+        for n in xrange(trace_lines))
+    for i in xrange(tests):
+        tag = '<testcase classname="pkg.test_mod%d.TestCase" name="test_%d" ' \
+            'time="0.%03d">' % (i % 50, i, i % 1000)
+        if i < failures:
+            tag += '<failure type="AssertionError" message="x">' \
+                '<![CDATA[%s]]></failure>' % trace
+        out.append(tag + '</testcase>')
+    out.append('</testsuite>')
+    return '\n'.join(out) + '\n'
+
+
+# fixtures
+
+class FakeWindow(object):
+    """Stand-in for a 50x160 curses window"""
+
+    def __init__(self):
+        self.writes = 0
+
+    def getmaxyx(self):
+        return 50, 160
+
+    def addstr(self, *args):
+        self.writes += 1
+
+    def erase(self):
+        pass
+
+    def border(self, *args):
+        pass
+
+    def refresh(self):
+        pass
+
+    def keypad(self, flag):
+        pass
+
+    def clrtoeol(self):
+        pass
+
+    def move(self, y, x):
+        pass
+
+    def hline(self, *args):
+        self.writes += 1
+
+    def timeout(self, delay):
+        pass
+
+    def getch(self):
+        return -1
+
+
+class FakeCurses(object):
+    """Provide the curses functions used by Screen without a terminal"""
+    A_BOLD = 0
+    ACS_HLINE = ord('-')
+    KEY_UP, KEY_DOWN, KEY_LEFT, KEY_RIGHT = 259, 258, 260, 261
+
+    def initscr(self):
+        return FakeWindow()
+
+    def __getattr__(self, name):
+        return lambda *args: None
+
+
+class FakeRunner(object):
+
+    def progress(self):
+        return 0, 0
+
+
+class FakeSupcut(object):
+    """The Supcut attributes used by Runner and Screen"""
+
+    def __init__(self, watched, failing):
+        self.root = os.getcwd()
+        self.dir = join(self.root, '.supcut')
+        self.tag = ''
+        self.watched = ['/src/pkg/mod%d.py' % i for i in xrange(watched)]
+        self.watched_set = set(self.watched)
+        self.watched_selected = set(self.watched)
+        self.watched_changed = set()
+        self.test_files = ['tests/test_mod%d.py' % i for i in xrange(50)]
+        self.test_files_selected = set(self.test_files)
+        self.failing_tests = ['test_%d (pkg.test_mod.TestCase)' % i
+            for i in xrange(failing)]
+        self.failing_tests_selected = set(self.failing_tests)
+        self.culprit = None
+        self.focus = False
+        self.failing_tests_dict = dict((t, ['line'] * 20)
+            for t in self.failing_tests)
+        self.total_tests_n = failing * 10
+        self.last_run = time()
+        self.last_run_duration = '1.000s'
+        self.lock = Lock()
+        self.currently_running = Lock()
+        self.runner = FakeRunner()
+        self.index = None
+        self.hashes = None
+        self.scheduler = Scheduler(lambda changed: None, quiet_period=3600)
+
+
+class Event(object):
+    """A pyinotify event"""
+
+    def __init__(self, pathname, mask, maskname):
+        self.pathname = pathname
+        self.mask = mask
+        self.maskname = maskname
+        self.dir = False
+
+
+# benchmarks, each returning a dict of measures
+
+def bench_parse_text(tests, failures):
+    data = nose_output(tests, failures)
+    t0 = time()
+    parser = NoseOutputParser()
+    for i in xrange(0, len(data), 65536):
+        parser.feed(data[i:i + 65536])
+    result = parser.close()
+    elapsed = time() - t0
+    assert len(result.failing) == failures and result.tot == tests
+    return dict(seconds=elapsed, mb_s=len(data) / elapsed / 2 ** 20,
+        tests_s=tests / elapsed)
+
+
+def bench_parse_xunit(tests, failures):
+    fd, path = tempfile.mkstemp()
+    os.write(fd, xunit_output(tests, failures))
+    os.close(fd)
+    t0 = time()
+    result = parse_xunit(path)
+    elapsed = time() - t0
+    os.unlink(path)
+    assert len(result.failing) == failures and result.tot == tests
+    return dict(seconds=elapsed, tests_s=tests / elapsed)
+
+
+def bench_save_output(tests, failures):
+    data = nose_output(tests, failures)
+    runner = core.Runner(sup=FakeSupcut(0, 0))
+    rounds = 20
+    t0 = time()
+    for i in xrange(rounds):
+        f = open('.supcut/output.new', 'w')
+        f.write(data)
+        f.close()
+        runner._save_output()
+    elapsed = (time() - t0) / rounds
+    return dict(seconds=elapsed, mb_s=len(data) / elapsed / 2 ** 20)
+
+
+def bench_merge_outputs(tests, failures):
+    shards = 4
+    runner = core.Runner(sup=FakeSupcut(0, 0))
+    units = []
+    per_shard = failures / shards or 1
+    for i in xrange(shards):
+        # the shards run different tests
+        data = nose_output(tests / shards or 1, per_shard, pkg='pkg%d' % i)
+        path = '.supcut/out.%d' % i
+        open(path, 'w').write(data)
+        parser = NoseOutputParser()
+        parser.feed(data)
+        parser.close()
+        units.append((path, parser))
+    t0 = time()
+    result = runner._merge_outputs(units, '.supcut/output.new')
+    elapsed = time() - t0
+    assert len(result.failing) == shards * per_shard, len(result.failing)
+    return dict(seconds=elapsed, failing=len(result.failing))
+
+
+def bench_archive(tests, failures):
+    archive = Archive('.supcut/archive.db', keep_runs=10)
+    rounds = 20
+    t0 = time()
+    for i in xrange(rounds):
+        # a few tests start or stop failing at every run
+        data = nose_output(tests, failures + i % 3)
+        open('.supcut/output', 'w').write(data)
+        parser = NoseOutputParser()
+        parser.feed(data)
+        archive.store(i, '.supcut/output', parser.close())
+    elapsed = (time() - t0) / rounds
+    runs, size, stored = archive.stats()
+    return dict(seconds=elapsed, mb_s=len(data) / elapsed / 2 ** 20,
+        ratio=float(size) / stored)
+
+
+def bench_events(n):
+    core.supcut = FakeSupcut(watched=10000, failing=0)
+    core.log = core.Log()
+    runner = core.Runner(sup=core.supcut)
+    watched = core.supcut.watched
+    ignored = ['/src/other/file%d.txt' % i for i in xrange(100)]
+    rnd = random.Random(0)
+    events = []
+    for i in xrange(n):
+        if i % 2:
+            path = rnd.choice(watched)
+        else:
+            path = rnd.choice(ignored)
+        events.append(Event(path, core.pyinotify.IN_CLOSE_WRITE,
+            'IN_CLOSE_WRITE'))
+    latencies = []
+    t0 = time()
+    for e in events:
+        t = time()
+        runner.process_default(e)
+        latencies.append(time() - t)
+    elapsed = time() - t0
+    core.supcut.scheduler.cancel()
+    latencies.sort()
+    return dict(seconds=elapsed, events_s=n / elapsed,
+        p50_us=latencies[len(latencies) / 2] * 1e6,
+        p99_us=latencies[int(len(latencies) * .99)] * 1e6)
+
+
+def bench_screen_refresh(tests, failures):
+    core.curses = FakeCurses()
+    core.supcut = FakeSupcut(watched=min(tests, 10000), failing=failures)
+    core.supcut.timings = core.Timings()
+    core.log = core.Log()
+    screen = core.Screen(parent=core.supcut)
+    window = screen._screen
+    rounds = 50
+    latencies = []
+    frames = 0
+    for menu in (0, 2, 3):
+        screen._current_menu = menu
+        for i in xrange(rounds):
+            # scrolling by one row, then an unchanged frame
+            for scroll in (i + 1, i + 1):
+                screen._scroll = scroll
+                t = time()
+                screen.refresh()
+                screen.render()
+                latencies.append(time() - t)
+                frames += 1
+    latencies.sort()
+    return dict(seconds=sum(latencies),
+        p50_ms=latencies[len(latencies) / 2] * 1e3,
+        p99_ms=latencies[int(len(latencies) * .99)] * 1e3,
+        writes=float(window.writes) / frames)
+
+
+def isolated(func, *args):
+    """Run a benchmark in a forked process, in a scratch directory.
+    Returns its measures and peak memory"""
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        tmp = tempfile.mkdtemp()
+        os.chdir(tmp)
+        os.mkdir('.supcut')
+        try:
+            d = func(*args)
+            d['peak_mb'] = resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss / 1024.0
+        except Exception, e:
+            d = dict(error=repr(e))
+        shutil.rmtree(tmp)
+        os.write(w, json.dumps(d))
+        os._exit(0)
+    os.close(w)
+    data = ''
+    for chunk in iter(lambda: os.read(r, 65536), ''):
+        data += chunk
+    os.close(r)
+    os.waitpid(pid, 0)
+    return json.loads(data)
+
+
+def main():
+    parser = OptionParser(usage="%prog [--quick] [case prefix ...]")
+    parser.add_option("-q", "--quick", action="store_true", default=False,
+        help="run the small sizes only")
+    options, prefixes = parser.parse_args()
+    sizes = QUICK_SIZES if options.quick else SIZES
+    event_counts = QUICK_EVENTS if options.quick else EVENTS
+
+    cases = []
+    for name in ('parse_text', 'parse_xunit', 'save_output',
+            'merge_outputs', 'archive', 'screen_refresh'):
+        for tests, failures in sizes:
+            cases.append(("%s %d/%d" % (name, tests, failures),
+                globals()['bench_' + name], (tests, failures)))
+    for n in event_counts:
+        cases.append(("events %d" % n, bench_events, (n, )))
+
+    for label, func, args in cases:
+        if prefixes and not [p for p in prefixes if label.startswith(p)]:
+            continue
+        d = isolated(func, *args)
+        print "%-32s %s" % (label, '  '.join("%s=%.3f" % (k, v)
+            if isinstance(v, float) else "%s=%s" % (k, v)
+            for k, v in sorted(d.iteritems())))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+#
+# supcut - Simple Unobtrusive Python Contituous Unit Testing
+#
+# Copyright (C) 2010 Federico Ceratto
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from hashlib import sha1
+from mmap import mmap, ACCESS_READ
+import sqlite3
+from threading import Lock
+from time import time
+import zlib
+
+from history import get_test_ids
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started REAL,
+    tot INTEGER,
+    failed INTEGER,
+    size INTEGER
+);
+CREATE TABLE IF NOT EXISTS chunks (
+    hash TEXT PRIMARY KEY,
+    data BLOB,
+    size INTEGER,
+    refs INTEGER
+);
+CREATE TABLE IF NOT EXISTS run_chunks (
+    run_id INTEGER,
+    seq INTEGER,
+    hash TEXT,
+    PRIMARY KEY (run_id, seq)
+);
+CREATE TABLE IF NOT EXISTS tests (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE
+);
+CREATE TABLE IF NOT EXISTS traces (
+    run_id INTEGER,
+    test_id INTEGER,
+    first INTEGER,
+    last INTEGER
+);
+CREATE INDEX IF NOT EXISTS traces_run ON traces (run_id, test_id);
+CREATE INDEX IF NOT EXISTS traces_test ON traces (test_id, run_id);
+"""
+
+# chunks larger than this are split, at a newline if possible
+CHUNK_SIZE = 65536
+
+
+def split_chunks(data, start, end):
+    """Split a byte range of data in chunks at most CHUNK_SIZE long,
+    returns their (start, end) bounds"""
+    bounds = []
+    while end - start > CHUNK_SIZE:
+        cut = data.rfind('\n', start, start + CHUNK_SIZE) + 1
+        if cut <= start:
+            cut = start + CHUNK_SIZE
+        bounds.append((start, cut))
+        start = cut
+    if end > start:
+        bounds.append((start, end))
+    return bounds
+
+
+class Archive(object):
+    """Outputs of the past runs, stored in SQLite as zlib compressed chunks.
+    The output is cut at the trace boundaries: each trace is stored in its
+    own chunks, and a chunk is stored once however many runs contain it,
+    e.g. the trace of a test failing for many runs in a row.
+    Only the most recent keep_runs runs, and the runs newer than keep_days
+    days if set, are kept.
+    """
+
+    def __init__(self, path='.supcut/archive.db', keep_runs=100, keep_days=0):
+        self._keep_runs = keep_runs
+        self._keep_days = keep_days
+        # used by the runner threads, serialized by the lock
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.text_factory = str
+        # effective on new databases only, before creating the tables
+        self._db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self._db.executescript(SCHEMA)
+        self._lock = Lock()
+
+    def store(self, started, path, result):
+        """Archive the output file of a run and the position of its traces,
+        given by the (offset, length) records of result.failing.
+        Returns the run id.
+        """
+        f = open(path, 'rb')
+        try:
+            try:
+                data = mmap(f.fileno(), 0, access=ACCESS_READ)
+            except (ValueError, EnvironmentError):
+                # empty output
+                return self._store(started, '', result)
+        finally:
+            f.close()
+        try:
+            return self._store(started, data, result)
+        finally:
+            data.close()
+
+    def _store(self, started, data, result):
+        """Archive the output data of a run"""
+        records = sorted((rec, name) for name, rec in
+            result.failing.iteritems() if isinstance(rec, tuple))
+        # cut at the trace boundaries, then at CHUNK_SIZE
+        bounds = []
+        traces = []     # (name, first chunk, last chunk)
+        pos = 0
+        for (start, length), name in records:
+            if start < pos:
+                # overlapping records, not expected
+                continue
+            bounds.extend(split_chunks(data, pos, start))
+            first = len(bounds)
+            bounds.extend(split_chunks(data, start, start + length))
+            traces.append((name, first, len(bounds) - 1))
+            pos = start + length
+        bounds.extend(split_chunks(data, pos, len(data)))
+
+        hashes = []
+        for start, end in bounds:
+            hashes.append(sha1(buffer(data, start, end - start)).hexdigest())
+
+        with self._lock:
+            cur = self._db.cursor()
+            cur.execute("INSERT INTO runs (started, tot, failed, size) "
+                "VALUES (?, ?, ?, ?)",
+                (started, result.tot, len(result.failing), len(data)))
+            run_id = cur.lastrowid
+            for (start, end), h in zip(bounds, hashes):
+                cur.execute("UPDATE chunks SET refs = refs + 1 "
+                    "WHERE hash = ?", (h, ))
+                if not cur.rowcount:
+                    cur.execute("INSERT INTO chunks VALUES (?, ?, ?, 1)",
+                        (h, sqlite3.Binary(zlib.compress(data[start:end])),
+                            end - start))
+            cur.executemany("INSERT INTO run_chunks VALUES (?, ?, ?)",
+                [(run_id, seq, h) for seq, h in enumerate(hashes)])
+            ids = get_test_ids(cur, [name for name, first, last in traces])
+            cur.executemany("INSERT INTO traces VALUES (?, ?, ?, ?)",
+                [(run_id, ids[name], first, last)
+                    for name, first, last in traces if last >= first])
+            self._prune(cur)
+            self._db.commit()
+        return run_id
+
+    def _prune(self, cur):
+        """Delete the runs beyond the retention limits and the chunks no
+        longer referenced"""
+        cur.execute("SELECT id FROM runs ORDER BY id DESC LIMIT -1 OFFSET ?",
+            (self._keep_runs, ))
+        old = set(row[0] for row in cur.fetchall())
+        if self._keep_days:
+            cur.execute("SELECT id FROM runs WHERE started < ?",
+                (time() - self._keep_days * 86400, ))
+            old.update(row[0] for row in cur.fetchall())
+        if not old:
+            return
+        for run_id in old:
+            cur.execute("SELECT hash, count(*) FROM run_chunks "
+                "WHERE run_id = ? GROUP BY hash", (run_id, ))
+            cur.executemany("UPDATE chunks SET refs = refs - ? "
+                "WHERE hash = ?", [(n, h) for h, n in cur.fetchall()])
+            for table in ('run_chunks', 'traces'):
+                cur.execute("DELETE FROM %s WHERE run_id = ?" % table,
+                    (run_id, ))
+            cur.execute("DELETE FROM runs WHERE id = ?", (run_id, ))
+        cur.execute("DELETE FROM chunks WHERE refs <= 0")
+        cur.execute("PRAGMA incremental_vacuum")
+
+    def _chunks(self, run_id, first=0, last=None):
+        """Yield the decompressed chunks of a run, one at a time"""
+        with self._lock:
+            sql = "SELECT hash FROM run_chunks WHERE run_id = ? AND seq >= ?"
+            args = [run_id, first]
+            if last is not None:
+                sql += " AND seq <= ?"
+                args.append(last)
+            hashes = [row[0] for row in
+                self._db.execute(sql + " ORDER BY seq", args)]
+        for h in hashes:
+            with self._lock:
+                row = self._db.execute("SELECT data FROM chunks "
+                    "WHERE hash = ?", (h, )).fetchone()
+            if row is None:
+                # pruned meanwhile
+                return
+            yield zlib.decompress(row[0])
+
+    def read(self, run_id):
+        """Yield the output of a run in chunks"""
+        return self._chunks(run_id)
+
+    def trace(self, run_id, name):
+        """Yield the trace of a test in a run in chunks, nothing if the
+        test did not fail"""
+        with self._lock:
+            row = self._db.execute("SELECT first, last FROM traces "
+                "JOIN tests ON tests.id = test_id "
+                "WHERE run_id = ? AND name = ?", (run_id, name)).fetchone()
+        if row is None:
+            return iter(())
+        return self._chunks(run_id, row[0], row[1])
+
+    def runs(self, n=50):
+        """Return the last n runs as (id, started, tot, failed, size)
+        tuples, oldest first"""
+        with self._lock:
+            rows = self._db.execute("SELECT id, started, tot, failed, size "
+                "FROM runs ORDER BY id DESC LIMIT ?", (n, )).fetchall()
+        return rows[::-1]
+
+    def failures(self, name, n=50):
+        """Return the last n runs where a test failed as (run id, started)
+        pairs, oldest first"""
+        with self._lock:
+            rows = self._db.execute("SELECT run_id, started FROM traces "
+                "JOIN tests ON tests.id = test_id "
+                "JOIN runs ON runs.id = run_id "
+                "WHERE name = ? ORDER BY run_id DESC LIMIT ?",
+                (name, n)).fetchall()
+        return rows[::-1]
+
+    def stats(self):
+        """Return the number of runs, the size of their outputs and the
+        size of the stored chunks, in bytes"""
+        with self._lock:
+            runs, size = self._db.execute("SELECT count(*), "
+                "coalesce(sum(size), 0) FROM runs").fetchone()
+            stored = self._db.execute("SELECT coalesce(sum(length(data)), 0) "
+                "FROM chunks").fetchone()[0]
+        return runs, size, stored
+
+    def close(self):
+        with self._lock:
+            self._db.close()
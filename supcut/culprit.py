@@ -0,0 +1,258 @@
+#
+# supcut - Simple Unobtrusive Python Contituous Unit Testing
+#
+# Copyright (C) 2010 Federico Ceratto
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from hashlib import sha1
+import json
+import os
+from os import killpg, listdir, makedirs, rename, setsid, unlink
+from os.path import dirname, isdir, isfile, join, relpath
+from Queue import Queue
+from shutil import copytree, ignore_patterns, rmtree
+from signal import SIGTERM
+from subprocess import Popen, PIPE, STDOUT
+import tempfile
+from threading import Lock, Thread
+
+from noseoutput import NoseOutputParser
+
+# not copied in the scratch trees
+IGNORE = ('.supcut', '.git', '.hg', '.svn', '*.pyc', '*.pyo')
+
+
+def read(fname):
+    """Return the contents of a file, None if missing"""
+    try:
+        return open(fname, 'rb').read()
+    except IOError:
+        return None
+
+
+class Snapshot(object):
+    """Contents of the watched files as of the last run, stored by hash in
+    the path directory. A file never recorded is considered missing.
+    """
+
+    def __init__(self, path='.supcut/snapshot'):
+        self._path = path
+        self._index = {}    # fname -> hash, None if missing
+        self._lock = Lock()
+        if not isdir(path):
+            makedirs(path)
+        index = join(path, 'index.json')
+        if isfile(index):
+            try:
+                self._index = json.load(open(index))
+            except ValueError:
+                pass
+
+    def known(self, fname):
+        with self._lock:
+            return fname in self._index
+
+    def get(self, fname):
+        """Return the recorded contents of a file, None if missing"""
+        with self._lock:
+            h = self._index.get(fname)
+        if h is None:
+            return None
+        return read(join(self._path, h))
+
+    def update(self, fnames):
+        """Record the current contents of the files"""
+        for fname in fnames:
+            data = read(fname)
+            h = None
+            if data is not None:
+                h = sha1(data).hexdigest()
+                blob = join(self._path, h)
+                if not isfile(blob):
+                    f = open(blob + '.new', 'wb')
+                    f.write(data)
+                    f.close()
+                    rename(blob + '.new', blob)
+            with self._lock:
+                self._index[fname] = h
+
+    def save(self):
+        """Persist the index and delete the blobs no longer used"""
+        index = join(self._path, 'index.json')
+        with self._lock:
+            f = open(index + '.new', 'w')
+            json.dump(self._index, f)
+            f.close()
+            rename(index + '.new', index)
+            used = set(self._index.itervalues())
+        for fn in listdir(self._path):
+            if len(fn) == 40 and fn not in used:
+                unlink(join(self._path, fn))
+
+
+class Bisector(object):
+    """Find the changed files breaking some tests by running them on
+    scratch copies of the project tree, with subsets of the changes
+    applied. The two halves of each step are tried in parallel, each on
+    its own tree.
+    When neither half breaks the tests on its own, the culprits are
+    searched in each half with the other one applied: the result is a
+    minimal set of files breaking the tests together.
+    """
+
+    def __init__(self, root, nose_opts='', log=None):
+        self._root = root
+        self._nose_opts = nose_opts
+        self._log = log or (lambda msg: None)
+        self._trees = Queue()
+        self._cancelled = False
+        self._procs = set()     # pids of the running probes
+        self._lock = Lock()
+        self.probes = 0
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+    def _kill(self, pid):
+        """Kill a probe process group"""
+        try:
+            killpg(pid, SIGTERM)
+        except OSError:
+            pass
+
+    def cancel(self):
+        """Kill the running probes and stop"""
+        with self._lock:
+            self._cancelled = True
+            for pid in self._procs:
+                self._kill(pid)
+
+    def _probe(self, tree, applied, changes, addresses):
+        """Run the tests on a scratch tree having the new contents of the
+        applied files and the old contents of the other changed files.
+        Returns True if any test fails.
+        """
+        for fname, (old, new) in changes.iteritems():
+            data = new if fname in applied else old
+            path = join(tree, relpath(fname, self._root))
+            if data is None:
+                if isfile(path):
+                    unlink(path)
+                continue
+            if not isdir(dirname(path)):
+                makedirs(dirname(path))
+            f = open(path, 'wb')
+            f.write(data)
+            f.close()
+        env = dict(os.environ, PYTHONDONTWRITEBYTECODE='1')
+        # run in a new process group to be able to kill its children
+        p = Popen("nosetests %s %s" % (self._nose_opts, ' '.join(addresses)),
+            shell=True, stdout=PIPE, stderr=STDOUT, close_fds=True,
+            preexec_fn=setsid, cwd=tree, env=env)
+        with self._lock:
+            self._procs.add(p.pid)
+            if self._cancelled:
+                self._kill(p.pid)
+        parser = NoseOutputParser()
+        try:
+            for chunk in iter(lambda: p.stdout.read(65536), ''):
+                parser.feed(chunk)
+        finally:
+            p.wait()
+            with self._lock:
+                self._procs.discard(p.pid)
+        result = parser.close()
+        self.probes += 1
+        return bool(result.failing) or result.tot is None
+
+    def _probe_all(self, subsets, changes, addresses):
+        """Probe subsets of the changes in parallel.
+        Returns the outcomes, None if cancelled."""
+        outcomes = [None] * len(subsets)
+
+        def worker(i, applied):
+            tree = self._trees.get()
+            try:
+                if not self._cancelled:
+                    outcomes[i] = self._probe(tree, applied, changes,
+                        addresses)
+            finally:
+                self._trees.put(tree)
+
+        threads = [Thread(target=worker, args=item)
+            for item in enumerate(subsets)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if self._cancelled or None in outcomes:
+            return None
+        return outcomes
+
+    def _search(self, suspects, base, changes, addresses):
+        """Return a minimal subset of suspects breaking the tests when
+        applied with base, None if cancelled"""
+        if len(suspects) == 1:
+            return suspects
+        half = len(suspects) / 2
+        a, b = suspects[:half], suspects[half:]
+        outcomes = self._probe_all([set(base + a), set(base + b)], changes,
+            addresses)
+        if outcomes is None:
+            return None
+        if outcomes[0]:
+            return self._search(a, base, changes, addresses)
+        if outcomes[1]:
+            return self._search(b, base, changes, addresses)
+        # broken by the interaction of both halves
+        found_a = self._search(a, base + b, changes, addresses)
+        if found_a is None:
+            return None
+        found_b = self._search(b, base + found_a, changes, addresses)
+        if found_b is None:
+            return None
+        return found_a + found_b
+
+    def run(self, changes, addresses):
+        """Find the files breaking the tests. changes maps the changed
+        files to their (old, new) contents, None meaning missing, and
+        addresses are the nosetests names of the broken tests.
+        Returns the culprit files, None if not found.
+        """
+        suspects = sorted(changes)
+        trees = []
+        try:
+            for i in xrange(2):
+                tree = join(tempfile.mkdtemp(prefix='supcut-bisect-'), 'tree')
+                copytree(self._root, tree, symlinks=True,
+                    ignore=ignore_patterns(*IGNORE))
+                trees.append(tree)
+                self._trees.put(tree)
+            # the tests must break with all the changes only
+            outcomes = self._probe_all([set(suspects), set()], changes,
+                addresses)
+            if outcomes is None:
+                return None
+            if outcomes != [True, False]:
+                self._log("unable to bisect: the tests %s" % ("fail "
+                    "without the changes" if outcomes[1] else "pass on a "
+                    "copy of the project"))
+                return None
+            return self._search(suspects, [], changes, addresses)
+        finally:
+            for tree in trees:
+                rmtree(dirname(tree), ignore_errors=True)
@@ -0,0 +1,208 @@
+#
+# supcut - Simple Unobtrusive Python Contituous Unit Testing
+#
+# Copyright (C) 2010 Federico Ceratto
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Local control socket and headless screen.
+
+The socket speaks JSON lines: each request is an object with a "cmd" key
+and gets one reply object, except "subscribe".
+    {"cmd": "status"}       run status, number of tests, failing tests
+    {"cmd": "failing"}      the failing tests and their traces
+    {"cmd": "run"}          run all the tests now
+    {"cmd": "focus"}        toggle running only the selected failing tests
+    {"cmd": "subscribe"}    stream the events, one object per line
+Errors are replied as {"error": "..."}.
+"""
+
+import json
+from os import chmod, unlink
+from os.path import exists
+from Queue import Full, Queue
+import socket
+from SocketServer import StreamRequestHandler, ThreadingMixIn, \
+    UnixStreamServer
+from sys import stdout
+from threading import Event, Lock, Thread
+
+
+class _Handler(StreamRequestHandler):
+    """Serve one client"""
+
+    def _send(self, d):
+        self.wfile.write(json.dumps(d) + '\n')
+        self.wfile.flush()
+
+    def handle(self):
+        try:
+            for line in iter(self.rfile.readline, ''):
+                try:
+                    cmd = json.loads(line)['cmd']
+                except (ValueError, KeyError, TypeError):
+                    self._send(dict(error='invalid request'))
+                    continue
+                if cmd == 'subscribe':
+                    self._stream()
+                    return
+                self._send(self.server.call(cmd))
+        except socket.error:
+            pass
+
+    def _stream(self):
+        """Send the events until the client disconnects"""
+        q = self.server.subscribe()
+        try:
+            while True:
+                event = q.get()
+                if event is None:
+                    return
+                self._send(event)
+        finally:
+            self.server.unsubscribe(q)
+
+
+class ControlServer(ThreadingMixIn, UnixStreamServer):
+    """Expose the supcut state on a Unix domain socket"""
+    daemon_threads = True
+
+    def __init__(self, sup, path='.supcut/socket', backlog=1000):
+        self._supcut = sup
+        self._path = path
+        self._backlog = backlog     # events queued for a slow subscriber
+        self._subscribers = set()
+        self._lock = Lock()
+        if exists(path):
+            probe = socket.socket(socket.AF_UNIX)
+            try:
+                probe.connect(path)
+            except socket.error:
+                unlink(path)    # left over by a crashed instance
+            else:
+                raise Exception("Another supcut instance is listening on %s"
+                    % path)
+            finally:
+                probe.close()
+        UnixStreamServer.__init__(self, path, _Handler)
+        chmod(path, 0600)
+        self._thread = Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def call(self, cmd):
+        """Reply to a command"""
+        sup = self._supcut
+        if cmd == 'status':
+            return sup.status()
+        elif cmd == 'failing':
+            with sup.lock:
+                d = sup.failing_tests_dict
+                return dict(failing=dict((name, d[name])
+                    for name in sup.failing_tests))
+        elif cmd == 'run':
+            sup.run_test_now()
+            return dict(ok=True)
+        elif cmd == 'focus':
+            return dict(focus=sup.toggle_focus())
+        return dict(error="unknown command %r" % cmd)
+
+    def subscribe(self):
+        q = Queue(self._backlog)
+        with self._lock:
+            self._subscribers.add(q)
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._subscribers.discard(q)
+
+    def publish(self, event):
+        """Send an event to the subscribers, dropping the ones which are
+        not keeping up"""
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            try:
+                q.put_nowait(event)
+            except Full:
+                self.unsubscribe(q)
+                with q.mutex:
+                    q.queue.clear()
+                q.put(None)
+
+    def close(self):
+        """Stop serving and remove the socket"""
+        self.shutdown()
+        self.server_close()
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            q.put(None)
+        try:
+            unlink(self._path)
+        except OSError:
+            pass
+
+
+class HeadlessScreen(object):
+    """Stand-in for Screen when running without a terminal: the messages
+    and the run summaries are printed, if echo is set, starting with
+    prefix"""
+
+    def __init__(self, parent=None, echo=True, prefix=''):
+        self._supcut = parent
+        self._echo = echo
+        self._prefix = prefix
+        self._requests = Queue()
+        self._stopped = Event()
+        self._last_run = None
+
+    def refresh(self, msg=None):
+        """Request a refresh. Can be called from any thread."""
+        self._requests.put(msg)
+
+    def render(self):
+        """Print the pending messages and the summary of a finished run"""
+        msgs = []
+        while not self._requests.empty():
+            msgs.append(self._requests.get())
+        if not self._echo or not msgs:
+            return bool(msgs)
+        for msg in msgs:
+            if msg is not None:
+                print self._prefix + msg
+        sup = self._supcut
+        if sup.last_run != self._last_run and \
+                not sup.currently_running.locked():
+            self._last_run = sup.last_run
+            print "%sTot: %d Failed: %d Len: %s" % (self._prefix,
+                sup.total_tests_n, len(sup.failing_tests),
+                sup.last_run_duration)
+            for name in sup.failing_tests:
+                print "%s  %s" % (self._prefix, name)
+        stdout.flush()
+        return True
+
+    def handle_keypress(self):
+        """Wait for stop()"""
+        if self._stopped.wait(.1):
+            raise KeyboardInterrupt
+
+    def stop(self):
+        """Make the main loop exit. Can be called from a signal handler."""
+        self._stopped.set()
+
+    def terminate(self):
+        pass
@@ -0,0 +1,132 @@
+#
+# supcut - Simple Unobtrusive Python Contituous Unit Testing
+#
+# Copyright (C) 2010 Federico Ceratto
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import deque
+from os import rename
+from os.path import getsize, isfile
+from Queue import Queue
+from threading import Thread
+from time import localtime, strftime, time
+
+
+class LogRecord(object):
+    """A log message and its timestamp"""
+    __slots__ = ('time', 'msg')
+
+    def __init__(self, t, msg):
+        self.time = t
+        self.msg = msg
+
+    def __str__(self):
+        return "%s %s" % (strftime('%H:%M:%S', localtime(self.time)),
+            self.msg)
+
+
+class LogFile(object):
+    """Append the log records to a file from a background thread, rotating
+    it to path.1, path.2... when it grows over max_bytes"""
+
+    def __init__(self, path, max_bytes=1048576, backups=3):
+        self._path = path
+        self._max_bytes = max_bytes
+        self._backups = backups
+        self._queue = Queue()
+        self._thread = Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, record):
+        """Queue a record"""
+        self._queue.put(record)
+
+    def close(self):
+        """Write the queued records and stop"""
+        self._queue.put(None)
+        self._thread.join(5)
+
+    def _rotate(self):
+        """Shift the backups, dropping the oldest one"""
+        for n in xrange(self._backups - 1, 0, -1):
+            old = "%s.%d" % (self._path, n)
+            if isfile(old):
+                rename(old, "%s.%d" % (self._path, n + 1))
+        if self._backups:
+            rename(self._path, self._path + '.1')
+        else:
+            open(self._path, 'w').close()
+
+    def _serve(self):
+        """Writer thread"""
+        size = getsize(self._path) if isfile(self._path) else 0
+        f = open(self._path, 'a')
+        while True:
+            records = [self._queue.get()]
+            while not self._queue.empty():
+                records.append(self._queue.get())
+            stop = None in records
+            data = ''.join("%s %s\n" % (strftime('%Y-%m-%d %H:%M:%S',
+                localtime(r.time)), r.msg) for r in records if r is not None)
+            if size and size + len(data) > self._max_bytes:
+                f.close()
+                self._rotate()
+                f = open(self._path, 'a')
+                size = 0
+            f.write(data)
+            f.flush()
+            size += len(data)
+            if stop:
+                f.close()
+                return
+
+
+class Log(object):
+    """Internal event logging, keeping the most recent records in memory
+    and optionally writing all of them to a rotating log file"""
+
+    def __init__(self, size=1000):
+        self.buffer = deque(maxlen=size)
+        self._file = None
+
+    def setup(self, size=1000, path=None, max_bytes=1048576, backups=3):
+        """Resize the buffer and start writing to a log file"""
+        self.buffer = deque(self.buffer, maxlen=size)
+        if path:
+            self._file = LogFile(path, max_bytes, backups)
+            for record in list(self.buffer):
+                self._file.write(record)
+
+    def append(self, msg):
+        record = LogRecord(time(), msg)
+        self.buffer.append(record)
+        if self._file:
+            self._file.write(record)
+
+    def tail(self, n=None, skip=0):
+        """Return the last n lines, skipping the newest skip ones"""
+        records = list(self.buffer)
+        if skip:
+            records = records[:-skip]
+        if n is not None:
+            records = records[-n:] if n else []
+        return [str(r) for r in records]
+
+    def close(self):
+        """Flush and close the log file"""
+        if self._file:
+            self._file.close()
+            self._file = None
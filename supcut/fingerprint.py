@@ -0,0 +1,103 @@
+#
+# supcut - Simple Unobtrusive Python Contituous Unit Testing
+#
+# Copyright (C) 2010 Federico Ceratto
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import ast
+from hashlib import sha1
+import json
+from os import rename, stat
+from os.path import isfile
+from threading import Lock
+
+
+class HashCache(object):
+    """Content hashes of the watched files, keyed by path and persisted in
+    .supcut. The hash is recomputed only if mtime or size changed.
+    With normalize, Python files are hashed through their AST: changes to
+    comments and whitespace do not change the hash.
+    """
+
+    def __init__(self, path='.supcut/hashes.json', normalize=False):
+        self._path = path
+        self._normalize = normalize
+        self._hashes = {}   # fname -> [mtime, size, hash]
+        self._lock = Lock()
+        self._dirty = False
+        if isfile(path):
+            try:
+                d = json.load(open(path))
+            except ValueError:
+                d = {}
+            if d.get('normalize') == normalize:
+                self._hashes = d['hashes']
+
+    def _hash(self, fname):
+        """Hash the contents of a file"""
+        data = open(fname, 'rb').read()
+        if self._normalize and fname.endswith('.py'):
+            try:
+                data = ast.dump(ast.parse(data, fname))
+            except (SyntaxError, TypeError, ValueError):
+                pass
+        return sha1(data).hexdigest()
+
+    def digest(self, fname):
+        """Return the hash of a file, None if missing"""
+        try:
+            st = stat(fname)
+        except OSError:
+            return None
+        with self._lock:
+            cached = self._hashes.get(fname)
+        if cached and cached[0] == st.st_mtime and cached[1] == st.st_size:
+            return cached[2]
+        try:
+            h = self._hash(fname)
+        except IOError:
+            return None
+        with self._lock:
+            self._hashes[fname] = [st.st_mtime, st.st_size, h]
+            self._dirty = True
+        return h
+
+    def changed(self, fname):
+        """Check if the contents of a file changed since the last call"""
+        with self._lock:
+            cached = self._hashes.get(fname)
+        old = cached[2] if cached else None
+        new = self.digest(fname)
+        if new is None:
+            with self._lock:
+                self._dirty |= self._hashes.pop(fname, None) is not None
+        return new != old
+
+    def prime(self, fnames):
+        """Hash the files which are not cached or are out of date"""
+        for fname in fnames:
+            self.digest(fname)
+
+    def save(self):
+        """Persist the hashes"""
+        with self._lock:
+            if not self._dirty:
+                return
+            d = dict(normalize=self._normalize, hashes=self._hashes)
+            f = open(self._path + '.new', 'w')
+            json.dump(d, f)
+            f.close()
+            rename(self._path + '.new', self._path)
+            self._dirty = False
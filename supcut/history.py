@@ -0,0 +1,320 @@
+#
+# supcut - Simple Unobtrusive Python Contituous Unit Testing
+#
+# Copyright (C) 2010 Federico Ceratto
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sqlite3
+from threading import Lock
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started REAL,
+    duration REAL,
+    tot INTEGER,
+    failed INTEGER,
+    cpu REAL,
+    max_rss INTEGER
+);
+CREATE TABLE IF NOT EXISTS changes (
+    run_id INTEGER,
+    path TEXT
+);
+CREATE TABLE IF NOT EXISTS tests (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE
+);
+CREATE TABLE IF NOT EXISTS results (
+    run_id INTEGER,
+    test_id INTEGER,
+    status TEXT,
+    duration REAL
+);
+CREATE TABLE IF NOT EXISTS stats (
+    test_id INTEGER PRIMARY KEY,
+    executions INTEGER,
+    total_duration REAL,
+    last_duration REAL,
+    last_status TEXT,
+    last_run INTEGER,
+    flips INTEGER,
+    unexplained_flips INTEGER,
+    baseline REAL,
+    timed INTEGER
+);
+CREATE TABLE IF NOT EXISTS usage (
+    run_id INTEGER,
+    unit TEXT,
+    wall REAL,
+    cpu REAL,
+    max_rss INTEGER
+);
+CREATE TABLE IF NOT EXISTS usage_stats (
+    unit TEXT PRIMARY KEY,
+    runs INTEGER,
+    wall REAL,
+    max_rss REAL
+);
+CREATE INDEX IF NOT EXISTS changes_run ON changes (run_id);
+CREATE INDEX IF NOT EXISTS results_test ON results (test_id, run_id);
+CREATE INDEX IF NOT EXISTS results_run ON results (run_id);
+CREATE INDEX IF NOT EXISTS stats_flips ON stats (unexplained_flips);
+CREATE INDEX IF NOT EXISTS usage_unit ON usage (unit, run_id);
+"""
+
+# upgrade the databases created by older versions: PRAGMA user_version
+# is the number of statements applied
+MIGRATIONS = [
+    "ALTER TABLE runs ADD COLUMN cpu REAL",
+    "ALTER TABLE runs ADD COLUMN max_rss INTEGER",
+    "ALTER TABLE stats ADD COLUMN baseline REAL",
+    "ALTER TABLE stats ADD COLUMN timed INTEGER DEFAULT 0",
+    # total_duration sums the timed executions only
+    "UPDATE stats SET total_duration = 0, timed = 0",
+]
+
+# weight of the last run in the rolling baselines
+ALPHA = .2
+# timed runs needed before comparing against a baseline
+MIN_SAMPLES = 3
+
+
+def get_test_ids(cur, names):
+    """Map test names to the ids of a tests table, adding the new ones"""
+    ids = {}
+    for name in names:
+        cur.execute("SELECT id FROM tests WHERE name = ?", (name, ))
+        row = cur.fetchone()
+        if row:
+            ids[name] = row[0]
+        else:
+            cur.execute("INSERT INTO tests (name) VALUES (?)", (name, ))
+            ids[name] = cur.lastrowid
+    return ids
+
+
+class History(object):
+    """Per-test outcome and duration of every run, and the resources used
+    by each nosetests process, stored in SQLite.
+    The stats tables are updated at every run to keep the queries on
+    slow and flaky tests independent from the history length. They hold
+    the rolling baselines of the test durations and of the processes wall
+    time and peak memory: a test taking more than slower_factor times its
+    baseline, and at least slower_min seconds more, got slower; a process
+    using more than memory_factor times its baseline, and at least
+    memory_min KB more, had a memory jump. A factor of 0 disables the check.
+    """
+
+    def __init__(self, path='.supcut/history.db', slower_factor=3.0,
+            slower_min=.1, memory_factor=1.5, memory_min=20480):
+        self._slower = (slower_factor, slower_min)
+        self._memory = (memory_factor, memory_min)
+        # used by the runner threads, serialized by the lock
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._migrate()
+        self._lock = Lock()
+
+    def _migrate(self):
+        """Create the tables, or upgrade the old ones"""
+        version = self._db.execute("PRAGMA user_version").fetchone()[0]
+        new = not self._db.execute("SELECT name FROM sqlite_master "
+            "WHERE type = 'table' AND name = 'stats'").fetchone()
+        if not new:
+            for sql in MIGRATIONS[version:]:
+                self._db.execute(sql)
+        self._db.executescript(SCHEMA)
+        self._db.execute("PRAGMA user_version = %d" % len(MIGRATIONS))
+        self._db.commit()
+
+    def _regression(self, limits, baseline, value):
+        """Check if a value exceeds its baseline by the given
+        (factor, minimum difference) limits"""
+        factor, minimum = limits
+        return bool(factor) and baseline is not None and \
+            value > baseline * factor and value - baseline >= minimum
+
+    def record(self, started, duration, result, changed=(), related=None,
+            passed=(), usage=None):
+        """Record a run. result is the RunResult of the executed tests,
+        changed the modified files triggering it and related the names of
+        the tests depending on them; by default all the tests are related
+        if any file changed. passed lists tests known to be successful
+        when the result does not have the status of every test.
+        usage maps the units (a test file, or the full run) to the (wall
+        time, CPU time, peak RSS in KB, timed) tuple of their nosetests
+        processes, where timed tells if the durations of its tests are
+        known: the wall time of the unit is checked otherwise. The None unit
+        is recorded without baselines.
+        Returns the run id and the regressions, as (category, name, detail)
+        tuples where category is 'slower' or 'memory'.
+        """
+        usage = usage or {}
+        regressions = []
+        tests = dict(result.tests)
+        # text output: only the failing and fixed tests are known
+        for name in result.failing:
+            if name not in tests:
+                tests[name] = ('fail', None)
+        for name in passed:
+            if name not in tests:
+                tests[name] = ('pass', None)
+        changed = [fn for fn in changed if fn is not None]
+        if related is None:
+            related = tests if changed else ()
+
+        with self._lock:
+            cur = self._db.cursor()
+            cur.execute("INSERT INTO runs "
+                "(started, duration, tot, failed, cpu, max_rss) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (started, duration, result.tot, len(result.failing),
+                    sum(u[1] for u in usage.itervalues()) if usage else None,
+                    max(u[2] for u in usage.itervalues()) if usage else None))
+            run_id = cur.lastrowid
+            cur.executemany("INSERT INTO changes (run_id, path) VALUES (?, ?)",
+                [(run_id, fn) for fn in changed])
+            ids = get_test_ids(cur, tests)
+            cur.executemany("INSERT INTO results "
+                "(run_id, test_id, status, duration) VALUES (?, ?, ?, ?)",
+                [(run_id, ids[name], status, dur)
+                    for name, (status, dur) in tests.iteritems()])
+
+            for name, (status, dur) in tests.iteritems():
+                cur.execute("SELECT last_status, timed, baseline "
+                    "FROM stats WHERE test_id = ?", (ids[name], ))
+                row = cur.fetchone()
+                timed = dur is not None and status == 'pass'
+                if row is None:
+                    cur.execute("INSERT INTO stats VALUES "
+                        "(?, 1, ?, ?, ?, ?, 0, 0, ?, ?)",
+                        (ids[name], dur if timed else 0, dur, status, run_id,
+                            dur if timed else None, int(timed)))
+                    continue
+                last_status, samples, baseline = row
+                if timed:
+                    if samples >= MIN_SAMPLES and \
+                            self._regression(self._slower, baseline, dur):
+                        regressions.append(('slower', name,
+                            "%.3fs -> %.3fs" % (baseline, dur)))
+                        # the new normal
+                        baseline = dur
+                    elif baseline is None:
+                        baseline = dur
+                    else:
+                        baseline += (dur - baseline) * ALPHA
+                flip = int(last_status != status)
+                unexplained = int(bool(flip) and name not in related)
+                cur.execute("UPDATE stats SET executions = executions + 1, "
+                    "total_duration = total_duration + ?, "
+                    "last_duration = ?, last_status = ?, last_run = ?, "
+                    "flips = flips + ?, "
+                    "unexplained_flips = unexplained_flips + ?, "
+                    "baseline = ?, timed = timed + ? WHERE test_id = ?",
+                    (dur if timed else 0, dur, status, run_id, flip,
+                        unexplained, baseline, int(timed), ids[name]))
+
+            for unit, (wall, cpu, max_rss, timed) in usage.iteritems():
+                cur.execute("INSERT INTO usage VALUES (?, ?, ?, ?, ?)",
+                    (run_id, unit, wall, cpu, max_rss))
+                if unit is not None:
+                    regressions.extend(self._check_usage(cur, unit, wall,
+                        max_rss, timed))
+            self._db.commit()
+        return run_id, regressions
+
+    def _check_usage(self, cur, unit, wall, max_rss, timed):
+        """Compare the resources used by a nosetests process with the
+        baselines of its unit, then update them.
+        Returns the regressions.
+        """
+        cur.execute("SELECT runs, wall, max_rss FROM usage_stats "
+            "WHERE unit = ?", (unit, ))
+        row = cur.fetchone()
+        if row is None:
+            cur.execute("INSERT INTO usage_stats VALUES (?, 1, ?, ?)",
+                (unit, wall, max_rss))
+            return []
+        runs, base_wall, base_rss = row
+        regressions = []
+        if runs >= MIN_SAMPLES and not timed and \
+                self._regression(self._slower, base_wall, wall):
+            regressions.append(('slower', unit,
+                "%.3fs -> %.3fs" % (base_wall, wall)))
+            base_wall = wall
+        else:
+            base_wall += (wall - base_wall) * ALPHA
+        if runs >= MIN_SAMPLES and \
+                self._regression(self._memory, base_rss, max_rss):
+            regressions.append(('memory', unit,
+                "%dMB -> %dMB" % (base_rss / 1024, max_rss / 1024)))
+            base_rss = max_rss
+        else:
+            base_rss += (max_rss - base_rss) * ALPHA
+        cur.execute("UPDATE usage_stats SET runs = runs + 1, wall = ?, "
+            "max_rss = ? WHERE unit = ?", (base_wall, base_rss, unit))
+        return regressions
+
+    def durations(self, names=None):
+        """Return the average duration of the tests timed at least once"""
+        with self._lock:
+            rows = self._db.execute("SELECT name, "
+                "total_duration / timed FROM stats "
+                "JOIN tests ON tests.id = test_id "
+                "WHERE timed > 0").fetchall()
+        d = dict(rows)
+        if names is not None:
+            d = dict((n, d[n]) for n in names if n in d)
+        return d
+
+    def slowest(self, n=10):
+        """Return the n slowest tests as (name, average duration) pairs"""
+        with self._lock:
+            return self._db.execute("SELECT name, "
+                "total_duration / timed AS avg FROM stats "
+                "JOIN tests ON tests.id = test_id "
+                "WHERE timed > 0 "
+                "ORDER BY avg DESC LIMIT ?", (n, )).fetchall()
+
+    def flaky(self, n=10):
+        """Return the n tests with most outcome changes not explained by a
+        related file change, as (name, flips, executions) tuples"""
+        with self._lock:
+            return self._db.execute("SELECT name, unexplained_flips, "
+                "executions FROM stats JOIN tests ON tests.id = test_id "
+                "WHERE unexplained_flips > 0 "
+                "ORDER BY unexplained_flips DESC LIMIT ?", (n, )).fetchall()
+
+    def trend(self, n=50):
+        """Return the last n runs as (started, duration, tot, failed)
+        tuples, oldest first"""
+        with self._lock:
+            rows = self._db.execute("SELECT started, duration, tot, failed "
+                "FROM runs ORDER BY id DESC LIMIT ?", (n, )).fetchall()
+        return rows[::-1]
+
+    def test_history(self, name, n=50):
+        """Return the last n outcomes of a test as (run id, status,
+        duration) tuples, oldest first"""
+        with self._lock:
+            rows = self._db.execute("SELECT run_id, status, duration "
+                "FROM results JOIN tests ON tests.id = test_id "
+                "WHERE name = ? ORDER BY run_id DESC LIMIT ?",
+                (name, n)).fetchall()
+        return rows[::-1]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
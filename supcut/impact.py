@@ -0,0 +1,136 @@
+#
+# supcut - Simple Unobtrusive Python Contituous Unit Testing
+#
+# Copyright (C) 2010 Federico Ceratto
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import ast
+import json
+from os import getcwd, rename
+from os.path import abspath, dirname, getmtime, isfile, join
+
+
+class ImpactGraph(object):
+    """Map test files to the project modules they import, directly or
+    indirectly. Import lists are cached by mtime and persisted in .supcut
+    """
+
+    def __init__(self, path='.supcut/impact.json', root=None):
+        self._path = path
+        self._root = abspath(root or getcwd())
+        self._imports = {}  # fname -> (mtime, [imported fnames])
+        self._dirty = False
+        self._load()
+
+    def _load(self):
+        """Load the cached import lists, if any"""
+        if not isfile(self._path):
+            return
+        try:
+            d = json.load(open(self._path))
+        except ValueError:
+            return
+        for fname, (mtime, deps) in d.iteritems():
+            self._imports[fname] = (mtime, deps)
+
+    def save(self):
+        """Persist the import lists"""
+        if not self._dirty:
+            return
+        f = open(self._path + '.new', 'w')
+        json.dump(self._imports, f)
+        f.close()
+        rename(self._path + '.new', self._path)
+        self._dirty = False
+
+    def _resolve(self, name, basedir):
+        """Resolve a dotted module name to a file inside the project.
+        Returns None for third party and stdlib modules"""
+        parts = name.split('.')
+        for base in (basedir, self._root):
+            path = join(base, *parts)
+            for candidate in (path + '.py', join(path, '__init__.py')):
+                if isfile(candidate):
+                    return candidate
+        return None
+
+    def _scan(self, fname):
+        """Parse a file and list the project files it imports"""
+        try:
+            tree = ast.parse(open(fname).read(), fname)
+        except (SyntaxError, IOError, TypeError):
+            return []
+        basedir = dirname(fname)
+        deps = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [a.name for a in node.names]
+            elif isinstance(node, ast.ImportFrom):
+                base = basedir
+                for i in xrange((node.level or 1) - 1):
+                    base = dirname(base)
+                module = node.module or ''
+                names = [module] if module else []
+                # "from pkg import mod" imports a module as well
+                names.extend("%s.%s" % (module, a.name) if module else a.name
+                    for a in node.names)
+                for n in names:
+                    found = self._resolve(n, base)
+                    if found:
+                        deps.add(found)
+                continue
+            else:
+                continue
+            for n in names:
+                # "import a.b.c" imports a, a.b and a.b.c
+                parts = n.split('.')
+                for i in xrange(1, len(parts) + 1):
+                    found = self._resolve('.'.join(parts[:i]), basedir)
+                    if found:
+                        deps.add(found)
+        return sorted(deps)
+
+    def imports(self, fname):
+        """Return the project files directly imported by fname"""
+        fname = abspath(join(self._root, fname))
+        try:
+            mtime = getmtime(fname)
+        except OSError:
+            return []
+        cached = self._imports.get(fname)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        deps = self._scan(fname)
+        self._imports[fname] = (mtime, deps)
+        self._dirty = True
+        return deps
+
+    def deps(self, fname):
+        """Return the set of project files reachable from fname,
+        including fname itself"""
+        fname = abspath(join(self._root, fname))
+        seen = set([fname])
+        todo = [fname]
+        while todo:
+            for dep in self.imports(todo.pop()):
+                if dep not in seen:
+                    seen.add(dep)
+                    todo.append(dep)
+        return seen
+
+    def affected(self, test_files, changed):
+        """Select the test files that can reach any of the changed files"""
+        changed = set(abspath(join(self._root, f)) for f in changed)
+        return [t for t in test_files if self.deps(t) & changed]
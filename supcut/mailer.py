@@ -16,9 +16,12 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from cgi import escape
+from email.MIMEImage import MIMEImage
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from smtplib import SMTP
+from os.path import join
+from smtplib import SMTP, SMTPServerDisconnected
 from string import Template
 
 colors = {
@@ -26,11 +29,19 @@ colors = {
     'failure': '#ffeeee'
 }
 
-def send_email(conf, category, name, out):
-    """Send HTML formatted email"""
-    if not conf.email_server:
-        return
+_images = {}    # path -> image contents
 
+def _image(path='/usr/share/pixmaps/faces/penguin.jpg'):
+    """Read the image attached to the emails once"""
+    if path not in _images:
+        try:
+            _images[path] = open(path, 'rb').read()
+        except IOError:
+            _images[path] = None
+    return _images[path]
+
+def _message(conf, category, name, html_output):
+    """Build an HTML formatted email"""
     # Create message container - the correct MIME type is multipart/alternative.
     msg = MIMEMultipart('alternative')
     msg['Subject'] = "%s %s: %s " % (conf.email_subject_tag, category, name)
@@ -41,13 +52,13 @@ def send_email(conf, category, name, out):
         bgcolor = colors[category],
         category = category,
         name = name,
-        output = '<br/>'.join(out),
+        output = html_output,
         tag = conf.email_subject_tag,
         sender = conf.email_sender,
         receivers = conf.email_receivers
     )
 
-    tpl = open('.supcut/email.tpl').read()
+    tpl = open(join(conf.dir, 'email.tpl')).read()
     tpl = Template(tpl)
     html = tpl.safe_substitute(d)
 
@@ -58,17 +69,58 @@ def send_email(conf, category, name, out):
     msg.attach(part)
 
     # adding icon
-    from email.MIMEImage import MIMEImage
+    image = _image()
+    if image is not None:
+        image = MIMEImage(image)
+        image.add_header('Content-ID', '<image1>')
+        msg.attach(image)
+    return msg
+
+
+class Mailer(object):
+    """Deliver emails over one SMTP connection, reopened when the server
+    drops it"""
+
+    def __init__(self, conf):
+        self._conf = conf
+        self._session = None
 
-    image = open('/usr/share/pixmaps/faces/penguin.jpg', 'rb').read()
-    image = MIMEImage(image)
-    image.add_header('Content-ID', '<image1>')
-    msg.attach(image)
+    def send(self, msg):
+        """Send a message, reconnecting once if needed"""
+        conf = self._conf
+        for attempt in (0, 1):
+            if self._session is None:
+                self._session = SMTP(conf.email_server)
+            try:
+                self._session.sendmail(conf.email_sender,
+                    conf.email_receivers, msg.as_string())
+                return
+            except SMTPServerDisconnected:
+                self._session = None
+                if attempt:
+                    raise
 
-    try:
-        session = SMTP(conf.email_server)
-        session.sendmail(conf.email_sender, conf.email_receivers, msg.as_string())
-        session.close()
-    except Exception,  e:
-        print("Unable to deliver email: %s", e)
+    def send_digest(self, title, fixed, failing, reports=()):
+        """Send one email listing the fixed tests, the failing tests
+        with their traces and the (category, name, detail) reports,
+        e.g. of regressions"""
+        out = []
+        for name, trace in failing:
+            out.append("<b>FAIL: %s</b>" % escape(name))
+            out.extend(escape(line) for line in trace or ())
+        for name in fixed:
+            out.append("<b>FIXED: %s</b>" % escape(name))
+        for category, name, detail in reports:
+            out.append("<b>%s: %s</b> %s" % (category.upper(), escape(name),
+                escape(detail)))
+        category = 'failure' if failing or reports else 'success'
+        self.send(_message(self._conf, category, title, '<br/>'.join(out)))
 
+    def close(self):
+        """Close the connection"""
+        if self._session is not None:
+            try:
+                self._session.quit()
+            except Exception:
+                pass
+            self._session = None
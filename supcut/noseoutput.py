@@ -0,0 +1,354 @@
+#
+# supcut - Simple Unobtrusive Python Contituous Unit Testing
+#
+# Copyright (C) 2010 Federico Ceratto
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+from mmap import mmap, ACCESS_READ
+from os import rename
+import re
+
+PROGRESS_CHARS = '.FES'
+
+
+def split_test_name(name):
+    """Split a test name in module and attribute path, e.g.
+    "test_x (pkg.test_mod.TestCase)" and "pkg.test_mod.TestCase.test_x"
+    to ("pkg.test_mod", "TestCase.test_x").
+    Returns None for names which are not addressable, e.g. docstrings.
+    """
+    m = re.match(r'^(\w+) \(([\w.]+)\)$', name)
+    if m:
+        name = "%s.%s" % (m.group(2), m.group(1))
+    elif not re.match(r'^[\w.]+$', name):
+        return None
+    parts = name.split('.')
+    if len(parts) < 2:
+        return None
+    # the attribute path starts at the test class, if any
+    for i in xrange(1, len(parts) - 1):
+        if parts[i][:1].isupper():
+            break
+    else:
+        i = len(parts) - 1
+    return '.'.join(parts[:i]), '.'.join(parts[i:])
+
+
+def canonical_test_name(name):
+    """Return the dotted name of a test, as reported by the xunit plugin,
+    e.g. "pkg.test_mod.TestCase.test_x" for "test_x (pkg.test_mod.TestCase)"
+    """
+    split = split_test_name(name)
+    if split is None:
+        return name
+    return '.'.join(split)
+
+
+class RunResult(object):
+    """Outcome of a nosetests run"""
+
+    def __init__(self):
+        # test name -> (offset, length) of the trace in the output file,
+        # or the trace lines when read from elsewhere
+        self.failing = {}
+        self.tests = {}     # test name -> (status, duration), if known
+        self.tot = None
+        self.run_time = None    # seconds
+        self.counts = {}    # e.g. {'failures': 2, 'errors': 1}
+        self.progress = 0   # tests completed, while running
+        self.progress_failed = 0
+
+    @classmethod
+    def merge(cls, results, run_time=None):
+        """Merge the results of separate runs.
+        The run time is the sum of the runs' times unless given.
+        """
+        merged = cls()
+        for r in results:
+            merged.failing.update(r.failing)
+            merged.tests.update(r.tests)
+            if r.tot is not None:
+                merged.tot = (merged.tot or 0) + r.tot
+            if r.run_time is not None:
+                merged.run_time = (merged.run_time or 0) + r.run_time
+            for k, v in r.counts.iteritems():
+                merged.counts[k] = merged.counts.get(k, 0) + v
+            merged.progress += r.progress
+            merged.progress_failed += r.progress_failed
+        if run_time is not None:
+            merged.run_time = run_time
+        return merged
+
+    def save(self, path):
+        """Persist the result as JSON"""
+        d = dict(
+            failing=self.failing,
+            tests=self.tests,
+            tot=self.tot,
+            run_time=self.run_time,
+            counts=self.counts,
+        )
+        f = open(path + '.new', 'w')
+        json.dump(d, f)
+        f.close()
+        rename(path + '.new', path)
+
+    @classmethod
+    def load(cls, path):
+        """Load a result saved by save()"""
+        d = json.load(open(path))
+        result = cls()
+        result.failing = dict((k, tuple(v) if _is_record(v) else v)
+            for k, v in d['failing'].iteritems())
+        result.tests = dict((k, tuple(v)) for k, v in d['tests'].iteritems())
+        result.tot = d['tot']
+        result.run_time = d['run_time']
+        result.counts = d['counts']
+        return result
+
+    def footer(self):
+        """Generate nose's summary lines"""
+        if self.counts:
+            status = "FAILED (%s)" % ', '.join("%s=%d" % i
+                for i in sorted(self.counts.iteritems()))
+        else:
+            status = "OK"
+        return [
+            '-' * 70,
+            "Ran %d tests in %.3fs" % (self.tot or 0, self.run_time or 0),
+            '',
+            status,
+        ]
+
+
+def _is_record(trace):
+    """Check if a trace is an (offset, length) record"""
+    return len(trace) == 2 and isinstance(trace[0], (int, long)) and \
+        isinstance(trace[1], (int, long))
+
+
+def shift_traces(failing, delta):
+    """Move the trace records of a failing dict by delta bytes"""
+    if not delta:
+        return dict(failing)
+    return dict((name, (trace[0] + delta, trace[1])
+        if isinstance(trace, tuple) else trace)
+        for name, trace in failing.iteritems())
+
+
+class Traces(object):
+    """Read-only mapping of the failing test names to their trace lines.
+    The traces are decoded on access from the output file, which is
+    memory mapped when the mapping is created: the output can be rotated
+    meanwhile. Traces longer than max_trace_lines are truncated.
+    """
+
+    def __init__(self, path, failing, max_trace_lines=1000):
+        self._failing = failing
+        self._max_trace_lines = max_trace_lines
+        self._map = None
+        self._last = None   # the last decoded (name, lines)
+        if any(isinstance(t, tuple) for t in failing.itervalues()):
+            try:
+                f = open(path, 'rb')
+                try:
+                    self._map = mmap(f.fileno(), 0, access=ACCESS_READ)
+                finally:
+                    f.close()
+            except (IOError, ValueError, EnvironmentError):
+                # missing or empty output
+                pass
+
+    def __getitem__(self, name):
+        trace = self._failing[name]
+        if not isinstance(trace, tuple):
+            return trace
+        if self._last and self._last[0] == name:
+            return self._last[1]
+        start, length = trace
+        if self._map is None:
+            return []
+        data = self._map[start:start + length]
+        lines = [line.rstrip() for line in data.split('\n')]
+        while lines and not lines[-1]:
+            lines.pop()
+        if len(lines) > self._max_trace_lines:
+            omitted = len(lines) - self._max_trace_lines
+            lines = lines[:self._max_trace_lines]
+            lines.append("[%d lines omitted]" % omitted)
+        self._last = (name, lines)
+        return lines
+
+    def get(self, name, default=None):
+        if name in self._failing:
+            return self[name]
+        return default
+
+    def __contains__(self, name):
+        return name in self._failing
+
+    def __iter__(self):
+        return iter(self._failing)
+
+    def __len__(self):
+        return len(self._failing)
+
+    def keys(self):
+        return self._failing.keys()
+
+
+class LayeredTraces(object):
+    """Traces of some tests taken from a newer run, e.g. of the focused
+    tests only, the others from the traces of the base run"""
+
+    def __init__(self, traces, base):
+        self.base = base
+        self._traces = traces
+
+    def __getitem__(self, name):
+        if name in self._traces:
+            return self._traces[name]
+        return self.base[name]
+
+    def get(self, name, default=None):
+        if name in self:
+            return self[name]
+        return default
+
+    def __contains__(self, name):
+        return name in self._traces or name in self.base
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def keys(self):
+        return list(set(self._traces.keys()) | set(self.base.keys()))
+
+
+class NoseOutputParser(object):
+    """Single pass parser for the nosetests text output.
+    It is fed with chunks of any size while nose is running and keeps the
+    result updated. The traces are not copied: the result only records
+    their position in the output.
+    """
+
+    def __init__(self):
+        self.result = RunResult()
+        # byte offsets of the failure sections in the output
+        self.sections_start = None
+        self.sections_end = None
+        # states: Outside, Header, Traceback, End
+        self._state = 'O'
+        self._name = None   # of the failing test being read
+        self._trace_start = None
+        self._partial = ''
+        self._counted = 0
+        self._offset = 0
+
+    def feed(self, data):
+        """Consume a chunk of output"""
+        lines = (self._partial + data).split('\n')
+        self._partial = lines.pop()
+        for line in lines:
+            self._line(line)
+            self._offset += len(line) + 1
+        if self._state == 'O':
+            # nose prints the progress dots without newlines
+            self._count_progress(self._partial)
+
+    def close(self):
+        """Consume the last unterminated line, if any"""
+        if self._partial:
+            self._line(self._partial)
+            self._offset += len(self._partial)
+            self._partial = ''
+        self._end_trace()
+        if self.sections_end is None:
+            self.sections_end = self._offset
+        if self.sections_start is None:
+            self.sections_start = self.sections_end
+        return self.result
+
+    def _count_progress(self, line):
+        """Count the completed tests from the progress line"""
+        if line.strip(PROGRESS_CHARS):
+            return
+        new = line[self._counted:]
+        self.result.progress += len(new)
+        self.result.progress_failed += new.count('F') + new.count('E')
+        self._counted = len(line)
+
+    def _end_trace(self):
+        """Record the position of the trace ending at the current line"""
+        if self._name is not None:
+            start = self._trace_start
+            if start is None:
+                start = self._offset
+            self.result.failing[self._name] = (start, self._offset - start)
+        self._name = None
+        self._trace_start = None
+
+    def _line(self, line):
+        """Consume a line"""
+        next_offset = self._offset + len(line) + 1
+        line = line.rstrip()
+        state = self._state
+        if line == '=' * 70 and state in ('O', 'T'):
+            if self.sections_start is None:
+                self.sections_start = self._offset
+            self._end_trace()
+            self._state = 'H'
+        elif line == '-' * 70:
+            if state == 'H':
+                self._state = 'T'
+                self._trace_start = next_offset
+            else:
+                # after the last test output
+                self._end_trace()
+                self.sections_end = self._offset
+                self._state = 'E'
+        elif state == 'H':
+            for prefix in ('FAIL: ', 'ERROR: '):
+                if line.startswith(prefix):
+                    self._name = line[len(prefix):]
+                    # until the trace is read
+                    self.result.failing[self._name] = (self._offset, 0)
+        elif state == 'E':
+            # example: "Ran 74 tests in 3.215s"
+            try:
+                if line.startswith('Ran '):
+                    li = line.split()
+                    self.result.tot = int(li[1])
+                    self.result.run_time = float(li[4].rstrip('s'))
+                elif line.startswith('FAILED ('):
+                    for item in line[8:-1].split(', '):
+                        k, v = item.split('=')
+                        self.result.counts[k] = int(v)
+            except (IndexError, ValueError):
+                # unexpected format, e.g. a plugin printing here
+                pass
+        elif state == 'O':
+            if ' ... ' in line:
+                # verbose output
+                self.result.progress += 1
+                if line.endswith(('FAIL', 'ERROR')):
+                    self.result.progress_failed += 1
+            else:
+                self._count_progress(line)
+            self._counted = 0
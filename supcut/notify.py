@@ -0,0 +1,195 @@
+#
+# supcut - Simple Unobtrusive Python Contituous Unit Testing
+#
+# Copyright (C) 2010 Federico Ceratto
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from Queue import Empty, Queue
+from threading import Thread
+from time import time
+
+
+# titles of the reports, i.e. the notifications with a description
+REPORTS = {
+    'slower': ('Test got slower', '%d slower'),
+    'memory': ('Memory jumped', '%d memory jumps'),
+    'culprit': ('Culprit found', '%d culprits'),
+}
+
+
+class Dispatcher(object):
+    """Deliver the notifications from a background thread, batched per
+    run in one summary OSD popup and one digest email.
+    When the dispatcher lags behind, the pending runs are merged: a test
+    fixed by a run and failing again in a later one (or the other way
+    round) is not notified at all.
+    """
+
+    def __init__(self, osd=None, mailer=None, timings=None, log=None,
+            max_names=5, prefix=''):
+        self._osd = osd         # callable(title, text, icon)
+        self._mailer = mailer
+        self._timings = timings
+        self._log = log
+        self._prefix = prefix   # of the log messages
+        self._max_names = max_names
+        self._queue = Queue()
+        self._carry = []    # events of a run not flushed yet
+        self._thread = Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def needs_traces(self):
+        """The traces of the failing tests are sent by email"""
+        return self._mailer is not None
+
+    def post(self, category, name, trace=None):
+        """Queue a notification: category is 'fixed' or 'failing' for a
+        test name, 'added' or 'removed' for a number of tests, 'slower' or
+        'memory' for a test or test file name and 'culprit' for changed
+        files, with a description in place of the trace"""
+        self._queue.put((category, name, trace))
+
+    def flush(self, timing=None):
+        """Deliver the notifications posted since the last flush, then
+        finish the run timings"""
+        self._queue.put(('flush', timing, None))
+
+    def stop(self):
+        """Deliver the pending notifications and stop"""
+        self._queue.put(None)
+        self._thread.join(10)
+        if self._mailer:
+            self._mailer.close()
+
+    def _serve(self):
+        """Dispatcher thread"""
+        while True:
+            items = [self._queue.get()]
+            # take whatever else is queued to merge stale runs
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except Empty:
+                    break
+            stop = None in items
+            items = self._carry + [i for i in items if i is not None]
+            flushes = [n for n, i in enumerate(items) if i[0] == 'flush']
+            if flushes:
+                last = flushes[-1]
+                self._carry = items[last + 1:]
+                items = items[:last + 1]
+                self._deliver([i for i in items if i[0] != 'flush'],
+                    [i[1] for i in items if i[0] == 'flush'])
+            else:
+                self._carry = items
+            if stop:
+                return
+
+    def _merge(self, events):
+        """Return the net fixed names, failing (name, trace) pairs, change
+        in the number of tests and (category, name, detail) reports"""
+        first, last = {}, {}
+        tot_diff = 0
+        reports = {}
+        for category, name, trace in events:
+            if category == 'added':
+                tot_diff += name
+            elif category == 'removed':
+                tot_diff -= name
+            elif category in REPORTS:
+                reports[(category, name)] = trace
+            else:
+                first.setdefault(name, category)
+                last[name] = (category, trace)
+        fixed, failing = [], []
+        for name in sorted(last):
+            category, trace = last[name]
+            if category != first[name]:
+                continue
+            if category == 'fixed':
+                fixed.append(name)
+            else:
+                failing.append((name, trace))
+        reports = [(category, name, detail)
+            for (category, name), detail in sorted(reports.iteritems())]
+        return fixed, failing, tot_diff, reports
+
+    def _summary(self, fixed, failing, tot_diff, reports):
+        """Return the title, text and icon of the summary popup"""
+        if len(fixed) + len(failing) == 1 and not tot_diff \
+                and not reports:
+            if fixed:
+                return fixed[0], 'Test fixed!', 'success'
+            return failing[0][0], 'Failing test', 'failure'
+        if len(reports) == 1 and not (fixed or failing or tot_diff):
+            category, name, detail = reports[0]
+            return REPORTS[category][0], "%s: %s" % (name, detail), 'failure'
+        parts = []
+        if failing:
+            parts.append("%d failing" % len(failing))
+        if fixed:
+            parts.append("%d fixed" % len(fixed))
+        if tot_diff > 0:
+            parts.append("%d test added" % tot_diff)
+        elif tot_diff < 0:
+            parts.append("%d test removed" % -tot_diff)
+        for category in sorted(REPORTS):
+            n = len([r for r in reports if r[0] == category])
+            if n:
+                parts.append(REPORTS[category][1] % n)
+        names = ["FAIL %s" % name for name, trace in failing] + \
+            ["fixed %s" % name for name in fixed] + \
+            ["%s %s: %s" % r for r in reports]
+        if len(names) > self._max_names:
+            more = len(names) - self._max_names + 1
+            names = names[:self._max_names - 1] + ["and %d more" % more]
+        icon = 'failure' if failing or reports else 'success'
+        return ', '.join(parts), '\n'.join(names), icon
+
+    def _deliver(self, events, timings):
+        """Show the summary popup and send the digest email"""
+        fixed, failing, tot_diff, reports = self._merge(events)
+        timings = [t for t in timings if t is not None]
+        if fixed or failing or tot_diff or reports:
+            title, text, icon = self._summary(fixed, failing, tot_diff,
+                reports)
+            if self._osd:
+                start = time()
+                try:
+                    self._osd(title, text, icon=icon)
+                except Exception, e:
+                    self._error("Unable to show notification: %s" % e)
+                for timing in timings:
+                    timing.add('osd', start)
+            if self._mailer and (fixed or failing or reports):
+                start = time()
+                try:
+                    self._mailer.send_digest(title, fixed, failing, reports)
+                except Exception, e:
+                    self._error("Unable to deliver email: %s" % e)
+                for timing in timings:
+                    timing.add('email', start)
+        if self._timings:
+            for timing in timings:
+                self._timings.finish(timing)
+                if self._log:
+                    self._log.append('%stimings: %s' % (self._prefix,
+                        timing.format()))
+
+    def _error(self, msg):
+        if self._log:
+            self._log.append(self._prefix + msg)
@@ -0,0 +1,79 @@
+#
+# supcut - Simple Unobtrusive Python Contituous Unit Testing
+#
+# Copyright (C) 2010 Federico Ceratto
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from fnmatch import translate
+from os import walk
+from os.path import abspath, join, sep
+import re
+
+
+class PathIndex(object):
+    """Match paths against include and exclude glob patterns relative to
+    a root directory. Each pattern list is compiled into a single regex.
+    Unlike shell globs, '*' matches across directories: "*.py" includes
+    the Python files at any depth.
+    """
+
+    def __init__(self, root, include, exclude=()):
+        self.root = abspath(root)
+        self._prefix = self.root + sep
+        self._include = self._compile(include)
+        self._exclude = self._compile(exclude)
+
+    def _compile(self, patterns):
+        """Compile glob patterns in one regex"""
+        patterns = [p for p in patterns if p]
+        if not patterns:
+            return None
+        return re.compile('|'.join("(?:%s)" % translate(p)
+            for p in patterns))
+
+    def _relative(self, path):
+        """Return the path relative to the root, or None if outside"""
+        if path.startswith(self._prefix):
+            return path[len(self._prefix):]
+        return None
+
+    def match(self, path):
+        """Check if an absolute file path is included and not excluded"""
+        rel = self._relative(path)
+        if rel is None or self._include is None:
+            return False
+        if not self._include.match(rel):
+            return False
+        return not (self._exclude and self._exclude.match(rel))
+
+    def excluded_dir(self, path):
+        """Check if a directory is excluded, e.g. by ".git/*" """
+        rel = self._relative(path)
+        if rel is None:
+            return path != self.root
+        return bool(self._exclude and self._exclude.match(rel + sep))
+
+    def scan(self):
+        """List the matching files under the root, skipping the
+        excluded directories"""
+        found = []
+        for dirpath, dirnames, filenames in walk(self.root):
+            dirnames[:] = sorted(d for d in dirnames
+                if not self.excluded_dir(join(dirpath, d)))
+            for fn in sorted(filenames):
+                path = join(dirpath, fn)
+                if self.match(path):
+                    found.append(path)
+        return found
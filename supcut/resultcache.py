@@ -0,0 +1,117 @@
+#
+# supcut - Simple Unobtrusive Python Contituous Unit Testing
+#
+# Copyright (C) 2010 Federico Ceratto
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import OrderedDict
+from hashlib import sha1
+import json
+from os import makedirs, rename, unlink
+from os.path import isdir, isfile, join
+from shutil import copyfile
+from threading import Lock
+
+from noseoutput import NoseOutputParser, RunResult
+
+
+class ResultCache(object):
+    """Results of test files, keyed by the hashes of the project files they
+    import and by a context: the run options and the hashes of the
+    watched files not imported, e.g. data files. The least recently used
+    entries are evicted when more than size are stored.
+    Each entry is the raw output and the result of the test file run.
+    """
+
+    def __init__(self, impact, hashes, path='.supcut/cache', size=1000):
+        self._impact = impact
+        self._hashes = hashes
+        self._path = path
+        self._size = size
+        self._lock = Lock()
+        self._index = OrderedDict()  # key -> [sections_start, sections_end]
+        if not isdir(path):
+            makedirs(path)
+        index = join(path, 'index.json')
+        if isfile(index):
+            try:
+                self._index = OrderedDict(json.load(open(index)))
+            except ValueError:
+                pass
+
+    def context(self, opts, fnames):
+        """Fingerprint the run options and the files which may affect any
+        test file"""
+        h = sha1(opts)
+        for fname in sorted(fnames):
+            h.update("%s\0%s\0" % (fname, self._hashes.digest(fname)))
+        return h.hexdigest()
+
+    def key(self, test_file, context):
+        """Fingerprint a test file and its dependencies"""
+        h = sha1(context)
+        for fname in sorted(self._impact.deps(test_file)):
+            h.update("%s\0%s\0" % (fname, self._hashes.digest(fname)))
+        return h.hexdigest()
+
+    def get(self, key):
+        """Return the cached (output file, parser) pair, or None"""
+        with self._lock:
+            sections = self._index.pop(key, None)
+            if sections is None:
+                return None
+            self._index[key] = sections
+        output = join(self._path, key)
+        try:
+            result = RunResult.load(output + '.json')
+        except (IOError, ValueError, KeyError):
+            return None
+        parser = NoseOutputParser()
+        parser.result = result
+        parser.sections_start, parser.sections_end = sections
+        return output, parser
+
+    def put(self, key, path, parser, keep=()):
+        """Store the output file and result of a run,
+        return the cached (output file, parser) pair.
+        The entries of the output files in keep are not evicted.
+        """
+        output = join(self._path, key)
+        copyfile(path, output)
+        parser.result.save(output + '.json')
+        with self._lock:
+            self._index.pop(key, None)
+            self._index[key] = [parser.sections_start, parser.sections_end]
+            for old in self._index.keys():
+                if len(self._index) <= self._size:
+                    break
+                if old == key or join(self._path, old) in keep:
+                    continue
+                del self._index[old]
+                for fn in (join(self._path, old),
+                        join(self._path, old + '.json')):
+                    if isfile(fn):
+                        unlink(fn)
+        return output, parser
+
+    def save(self):
+        """Persist the index and the import lists"""
+        self._impact.save()
+        index = join(self._path, 'index.json')
+        with self._lock:
+            f = open(index + '.new', 'w')
+            json.dump(self._index.items(), f)
+            f.close()
+        rename(index + '.new', index)
@@ -0,0 +1,184 @@
+#
+# supcut - Simple Unobtrusive Python Contituous Unit Testing
+#
+# Copyright (C) 2010 Federico Ceratto
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import deque
+from threading import Condition, Lock, Thread
+from time import time
+
+
+class Scheduler(object):
+    """Coalesce bursts of file changes into a single test run, started
+    once no change happened for quiet_period seconds.
+    Changes arriving during a run are accumulated and trigger exactly one
+    follow-up run. If a cancel function is given, the current run is
+    preempted instead and its changes are carried over to the next one.
+    """
+
+    def __init__(self, run, quiet_period=1.0, cancel=None, limiter=None,
+            reset=None):
+        """run is called with the set of changed files,
+        None in the set means that a full run is required.
+        With a limiter, each run waits for a free slot.
+        reset is called once the changes of a run are taken, before any
+        cancel preempting it."""
+        self._run = run
+        self._cancel = cancel
+        self._reset = reset
+        self._limiter = limiter
+        self.quiet_period = quiet_period
+        self._lock = Lock()
+        self._cond = Condition(self._lock)
+        self._changed = set()
+        self._timer = None      # the thread waiting for the deadline
+        self._deadline = None
+        self._running = False
+        self._waiting = False
+        self._preempted = False
+        self._burst_started = None
+        # time of the first change handled by the current run
+        self.burst_started = None
+
+    @property
+    def running(self):
+        return self._running
+
+    @property
+    def waiting(self):
+        """A run is waiting for a slot of the limiter"""
+        return self._waiting
+
+    def notify(self, fname, delay=None):
+        """Record a changed file and (re)start the quiet period"""
+        with self._lock:
+            if not self._changed:
+                self._burst_started = time()
+            self._changed.add(fname)
+            if self._running:
+                # picked up when the current run ends
+                if self._cancel and not self._preempted:
+                    self._preempted = True
+                    self._cancel()
+                return
+            self._start_timer(delay)
+
+    def _start_timer(self, delay=None):
+        """Start or restart the timer. Must be called with the lock held"""
+        if delay is None:
+            delay = self.quiet_period
+        self._deadline = time() + delay
+        if self._timer:
+            # a single thread waits, however many changes arrive
+            self._cond.notify()
+            return
+        self._timer = Thread(target=self._wait)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _wait(self):
+        """Timer thread: wait for the deadline, which the changes arriving
+        meanwhile move, then fire"""
+        with self._lock:
+            while self._deadline is not None:
+                left = self._deadline - time()
+                if left <= 0:
+                    break
+                self._cond.wait(left)
+            self._timer = None
+            if self._deadline is None:
+                # cancelled
+                return
+            self._deadline = None
+        self._fire()
+
+    def _fire(self):
+        """Run the tests on the accumulated changes"""
+        if self._limiter:
+            with self._lock:
+                if self._running or self._waiting or not self._changed:
+                    return
+                self._waiting = True
+            # changes arriving in the meantime join this run
+            self._limiter.acquire()
+            with self._lock:
+                self._waiting = False
+        try:
+            self._fire_run()
+        finally:
+            if self._limiter:
+                self._limiter.release()
+
+    def _fire_run(self):
+        """Run the tests on the accumulated changes"""
+        with self._lock:
+            if self._running or not self._changed:
+                return
+            changed = self._changed
+            self._changed = set()
+            self._running = True
+            self._preempted = False
+            self.burst_started = self._burst_started
+            if self._reset:
+                self._reset()
+        try:
+            self._run(changed)
+        finally:
+            with self._lock:
+                self._running = False
+                if self._preempted:
+                    if not self._changed:
+                        self._burst_started = self.burst_started
+                    self._changed |= changed
+                if self._changed:
+                    self._start_timer()
+
+    def cancel(self):
+        """Drop the scheduled run, if any"""
+        with self._lock:
+            self._deadline = None
+            self._cond.notify()
+            self._changed = set()
+
+
+class Limiter(object):
+    """Limit the number of concurrent runs, granting the free slots in
+    the order they were requested. Since each Scheduler waits for one
+    slot at a time, the projects sharing a limiter take turns.
+    """
+
+    def __init__(self, slots):
+        self._slots = slots
+        self._cond = Condition()
+        self._queue = deque()
+
+    def acquire(self):
+        """Wait for a free slot"""
+        ticket = object()
+        with self._cond:
+            self._queue.append(ticket)
+            while self._queue[0] is not ticket or not self._slots:
+                self._cond.wait()
+            self._queue.popleft()
+            self._slots -= 1
+            # the next in line can take another free slot
+            self._cond.notify_all()
+
+    def release(self):
+        """Free a slot"""
+        with self._cond:
+            self._slots += 1
+            self._cond.notify_all()
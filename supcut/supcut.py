@@ -18,30 +18,62 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from ConfigParser import SafeConfigParser
+from fcntl import fcntl, F_GETFL, F_SETFL
+from multiprocessing import cpu_count
 import curses
+import json
 from optparse import OptionParser
-from os import getcwd, makedirs, rename
-from os.path import isdir, isfile
+from os import close, dup2, fork, killpg, makedirs, mkfifo, read, \
+    rename, sep, setsid, unlink, wait4, _exit, O_NONBLOCK, O_RDONLY, O_RDWR
+from os import open as os_open
+from os.path import abspath, basename, dirname, exists, isdir, isfile, join, \
+    relpath
+from Queue import Queue, Empty
 import pyinotify        # this is Inotify (file alteration)
+import shlex
 from shutil import copyfile
+from signal import signal, SIGTERM
 from setproctitle import setproctitle
 from subprocess import Popen, PIPE, STDOUT
-from sys import exit
-from threading import Lock
-from time import time, gmtime, strftime
-
-from mailer import send_email
+from sys import exit, stdout
+from threading import current_thread, Lock, Thread
+from time import time, gmtime, localtime, strftime
+
+from archive import Archive
+from culprit import Bisector, Snapshot, read as read_file
+from daemon import ControlServer, HeadlessScreen
+from eventlog import Log
+from fingerprint import HashCache
+from history import History
+from impact import ImpactGraph
+from mailer import Mailer
+from notify import Dispatcher
+from pathindex import PathIndex
+from resultcache import ResultCache
+from noseoutput import canonical_test_name, LayeredTraces, \
+    NoseOutputParser, RunResult, shift_traces, split_test_name, Traces
+from scheduler import Limiter, Scheduler
+from timing import RunTimings, Timings
+from warm import WarmWorker
+from xunit import parse_xunit
 
 try:
     import gtk
     import pynotify as osd  # this is Notify (OSD messages)
     osd_available = True
+    # the notifications are shown by the dispatcher thread
+    gtk.gdk.threads_init()
     osd.init('Supcut')
 except ImportError:
     osd_available = False
 
 __version__ = '0.6-unreleased'
 
+# file writes, renames and deletions. IN_CREATE is needed to watch new
+# directories
+WATCH_MASK = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | \
+    pyinotify.IN_MOVED_FROM | pyinotify.IN_DELETE | pyinotify.IN_CREATE
+
 supcut = None
 log = None
 
@@ -52,33 +84,80 @@ def say(s, newline=True):
     else:
         print s,
 
-class Log(object):
-    """Internal event logging"""
-
-    def __init__(self):
-        self.buffer = []
-
-    def append(self, msg):
-        self.buffer.append("%s %s" % (strftime('%H:%M:%S'), msg))
-
-
 class Conf(object):
     """Read configuration file, and create the .supcut directory if needed"""
 
-    def __init__(self):
-        if not isdir('.supcut'):
+    # values used when an option is missing from config.ini
+    defaults = {
+        'impact_analysis': 'False',
+        'full_run_every': '10',
+        'workers': '1',
+        'quiet_period': '1.0',
+        'preempt': 'False',
+        'ingest': 'text',
+        'history': 'True',
+        'order': 'discovery',
+        'warm_workers': 'False',
+        'preload': 'nose',
+        'recursive': 'False',
+        'exclude': '.git/* .hg/* .svn/* .supcut/* *.pyc',
+        'skip_noop_writes': 'False',
+        'ignore_cosmetic': 'False',
+        'result_cache': 'False',
+        'result_cache_size': '1000',
+        'timings_log': '',
+        'timings_trace': '',
+        'log_size': '1000',
+        'log_file': '',
+        'log_file_size': '1048576',
+        'log_backups': '3',
+        'socket': 'False',
+        'archive': 'False',
+        'archive_runs': '100',
+        'archive_days': '0',
+        'slower_factor': '3.0',
+        'slower_min': '0.1',
+        'memory_factor': '1.5',
+        'memory_min': '20',
+        'bisect': 'False',
+        'focus_quiet_period': '0.05',
+    }
+    booleans = ('verbose', 'send_osd_notifications', 'impact_analysis',
+        'preempt', 'history', 'warm_workers', 'recursive',
+        'skip_noop_writes', 'ignore_cosmetic', 'result_cache', 'socket',
+        'archive', 'bisect')
+    ints = ('full_run_every', 'workers', 'result_cache_size', 'log_size',
+        'log_file_size', 'log_backups', 'archive_runs', 'archive_days',
+        'memory_min')
+    # ints which must be at least 1
+    positive = ('workers', 'archive_runs')
+    floats = ('quiet_period', 'slower_factor', 'slower_min', 'memory_factor',
+        'focus_quiet_period')
+
+    def __init__(self, root='.'):
+        self.dir = join(abspath(root), '.supcut')
+        if not isdir(self.dir):
             self._dir_setup()
-        for fn in ('.supcut/config.ini', '.supcut/email.tpl'):
-            if not isfile(fn):
-                say("The file %s is missing." % fn)
+        for fn in ('config.ini', 'email.tpl'):
+            if not isfile(join(self.dir, fn)):
+                say("The file %s is missing." % join(self.dir, fn))
+                exit(1)
+        self.cp = SafeConfigParser(self.defaults)
+        self.cp.read(join(self.dir, 'config.ini'))
+        for name in self.positive:
+            if getattr(self, name) < 1:
+                say("%s must be at least 1 in %s." % (name,
+                    join(self.dir, 'config.ini')))
                 exit(1)
-        self.cp = SafeConfigParser()
-        self.cp.read('.supcut/config.ini')
 
     def __getattr__(self, name):
         """Expose a conf variable as an attr"""
-        if name in ('verbose', 'send_osd_notifications'):
+        if name in self.booleans:
             return self.cp.getboolean('global', name)
+        elif name in self.ints:
+            return self.cp.getint('global', name)
+        elif name in self.floats:
+            return self.cp.getfloat('global', name)
         elif name.startswith('email_'):
             return self.cp.get('email', name[6:])
         return self.cp.get('global', name)
@@ -88,40 +167,43 @@ class Conf(object):
         say("""First supcut run: a directory called .supcut should
     be created at the root directory of your project.
 
-    The current path is: %s""" % getcwd())
+    The path is: %s""" % dirname(self.dir))
         a = raw_input('Create .supcut directory [y/N]? ')
         if a != 'y':
             exit(0)
-        makedirs('.supcut')
+        makedirs(self.dir)
         say("Creating configuration file")
         copyfile('/usr/share/doc/python-supcut/examples/config.ini',
-            '.supcut/config.ini')
+            join(self.dir, 'config.ini'))
         say("Creating email template file")
         copyfile('/usr/share/doc/python-supcut/examples/email.tpl',
-            '.supcut/email.tpl')
+            join(self.dir, 'email.tpl'))
 
 
 class Screen(object):
-    """Handle ncurses screen"""
+    """Handle ncurses screen.
+    Drawing happens in the main thread only: the other threads request a
+    refresh, and the requests are coalesced and rendered by render().
+    Only the rows which changed since the previous frame are redrawn, and
+    only the visible rows of the lists are formatted.
+    """
+
+    tabs = ('Monitored files', 'Test files', 'Failing tests', 'Test output')
 
     def __init__(self, parent=None):
         """Setup curses screen"""
         self._supcut = parent
-        self._menu = [
-            ['Monitored files', self._supcut.watched,
-                self._supcut.watched_selected],
-            ['Test files', self._supcut.test_files,
-                self._supcut.test_files_selected],
-            ['Failing tests',self._supcut.failing_tests,
-                self._supcut.failing_tests_selected],
-            ['Test output']
-        ]
-
         self._current_menu = 0
         self._y = 0
         self._scroll = 0
         self._cursor = 1
         self._overflow = False
+        self._logpane = False
+        self._log_scroll = 0
+        self._requests = Queue()    # refresh requests: footer messages
+        self._frame = {}    # row -> [(col, text, bold)] being drawn
+        self._drawn = {}    # row -> [(col, text, bold)] on screen
+        self._size = None   # screen size of the drawn frame
 
 
         screen = curses.initscr()
@@ -130,16 +212,34 @@ class Screen(object):
         screen.keypad(1)
         screen.border(0)
         screen.refresh()
+        # wake up the main loop to render the refresh requests
+        screen.timeout(100)
         self._screen = screen
 
+    def _tab(self):
+        """Return the title, the items and the selected items of the
+        current tab"""
+        sup = self._supcut
+        n = self._current_menu
+        if n == 0:
+            return self.tabs[0], sup.watched, sup.watched_selected
+        elif n == 1:
+            return self.tabs[1], sup.test_files, sup.test_files_selected
+        elif n == 2:
+            return self.tabs[2], sup.failing_tests, sup.failing_tests_selected
+        return self.tabs[3], None, None
+
     def _blank(self):
-        """Erase the screen"""
-        self._screen.erase()
-        self._screen.border(0)
+        """Start a new frame"""
+        self._frame = {}
         self._cursor = 1
         self._overflow = False
 
     def addstr(self, row, col, s, bold=False):
+        """Add a string to the frame"""
+        self._frame.setdefault(row, []).append((col, s, bold))
+
+    def _write(self, row, col, s, bold=False):
         """Proxy for curses screen.addstr,
         ignore exceptions to prevent crashing on small terminals
         """
@@ -151,6 +251,32 @@ class Screen(object):
         except:
             pass
 
+    def _flush(self):
+        """Write the rows which changed since the previous frame"""
+        screen = self._screen
+        max_y, max_x = screen.getmaxyx()
+        if (max_y, max_x) != self._size:
+            # resized: redraw everything
+            self._size = (max_y, max_x)
+            self._drawn = {}
+            screen.erase()
+            screen.border(0)
+        for row in set(self._drawn) | set(self._frame):
+            segments = self._frame.get(row)
+            if self._drawn.get(row) == segments:
+                continue
+            try:
+                if row == max_y - 1:
+                    screen.hline(row, 1, curses.ACS_HLINE, max_x - 2)
+                else:
+                    screen.hline(row, 1, ' ', max_x - 2)
+            except:
+                pass
+            for col, s, bold in segments or ():
+                self._write(row, col, s, bold)
+        self._drawn = self._frame
+        screen.refresh()
+
     def _print(self, s, bold=None):
         """Print on curses screen"""
         max_y, max_x = self._screen.getmaxyx()
@@ -175,53 +301,29 @@ class Screen(object):
             self._cursor += 1
 
     def _print_column(self):
-        """Print items in a column flagging the selected ones,
-        highlighting one of them"""
-        self._menu = (
-            ['Monitored files', self._supcut.watched,
-                self._supcut.watched_selected],
-            ['Test files', self._supcut.test_files,
-                self._supcut.test_files_selected],
-            ['Failing tests',self._supcut.failing_tests,
-                self._supcut.failing_tests_selected],
-            ['Test output']
-        )
-        title, li, selected = self._menu[self._current_menu]
+        """Print the visible items in a column flagging the selected and
+        the changed ones, highlighting one of them"""
+        title, li, selected = self._tab()
+        changed = ()
         if title == 'Monitored files':
-            self._print_monitored_files()
-            return
+            changed = self._supcut.watched_changed
+        elif title == 'Failing tests' and self._supcut.culprit:
+            self._print("Broken by %s" % ', '.join(self._supcut.culprit),
+                bold=True)
 
         if self._scroll:
             self._print("   ^^^")
-        for n, item in enumerate(li[self._scroll:]):
-            sel = item in selected
-            sel = "+" if sel else " "
+        max_y, max_x = self._screen.getmaxyx()
+        # one more row than the visible ones to flag the overflow
+        visible = li[self._scroll:self._scroll + max_y - 1 - self._cursor]
+        for n, item in enumerate(visible):
+            flag = "!" if item in changed else " "
+            sel = "+" if item in selected else " "
             bold = (n == self._y)
-            self._print(" %s %s" % (sel, item), bold=bold)
+            self._print("%s%s %s" % (flag, sel, item), bold=bold)
         if title == 'Monitored files':
             self._print("%d files watched" % len(self._supcut.watched_selected))
 
-    def _print_monitored_files(self):
-        """Print monitored files in a column
-        """
-        title = 'Monitored files'
-        li = self._supcut.watched
-        selected = self._supcut.watched_selected
-        changed = self._supcut.watched_changed
-
-        if self._scroll:
-            self._print("   ^^^")
-        for n, item in enumerate(li[self._scroll:]):
-            sel = item in selected
-            sel = "+" if sel else " "
-            bold = (n == self._y)
-            if item == changed:
-                self._print("!%s %s" % (sel, item), bold=bold)
-            else:
-                self._print(" %s %s" % (sel, item), bold=bold)
-
-        self._print("%d files watched" % len(self._supcut.watched_selected))
-
     def _print_footer(self, s):
         """Print footer message"""
         max_y, max_x = self._screen.getmaxyx()
@@ -238,58 +340,79 @@ class Screen(object):
             return
 
         self._print("     -- %s --" % test_name)
-        for line in self._supcut.failing_tests_dict[test_name][self._scroll:]:
+        max_y, max_x = self._screen.getmaxyx()
+        trace = self._supcut.failing_tests_dict[test_name]
+        rows = max_y - 1 - self._cursor
+        for line in trace[self._scroll:self._scroll + rows]:
             self._print(line)
 
-    def refresh(self, msg=None, menu=None):
-        """Refresh curses screen"""
+    def _print_log(self):
+        """Print the timings summary and the most recent log lines"""
+        max_y, max_x = self._screen.getmaxyx()
+        self.addstr(1, 2, 'Log', bold=True)
+        self._cursor = 3
+        summary = self._supcut.timings.format_summary()
+        for line in summary:
+            self._print(line)
+        if summary:
+            self._cursor += 1
+        if self._log_scroll:
+            self._print("   ^^^")
+        rows = max_y - 2 - self._cursor
+        lines = log.tail(rows, skip=self._log_scroll)
+        self._overflow = len(lines) == rows and rows > 0
+        for line in lines:
+            self._print(line[:max_x - 4])
+
+    def refresh(self, msg=None):
+        """Request a refresh of the screen, showing msg in the footer.
+        Can be called from any thread."""
+        self._requests.put(msg)
+
+    def render(self):
+        """Draw the screen if a refresh has been requested"""
+        msg = None
+        requested = False
+        while True:
+            try:
+                msg = self._requests.get_nowait()
+                requested = True
+            except Empty:
+                break
+        if requested:
+            self._render(msg)
+        return requested
+
+    def _render(self, msg=None):
+        """Draw the screen"""
         self._blank()
 
         if hasattr(self._supcut, '_msg'):
             self._print(self._supcut._msg)
         sup = self._supcut
-        with sup.lock:
-            #self._print("Watched: %3d  Tot: %3d  Failed: %3d"
-            #    " Last run: %8s Len: %7s Running: [%s]" % (
-            #    len(sup.watched_selected),
-            #    sup.total_tests_n,
-            #    len(sup.failing_tests),
-            #    sup.last_run,
-            #    sup.last_run_duration,
-            #    "*" if sup.currently_running.locked() else " "
-            #))
-            running = msg is None and sup.currently_running.locked()
-            if running:
-                msg = "Running..."
-            elif msg is None:
-                tstamp = "--:--:--"
-                if sup.last_run:
-                    tstamp =  strftime("%H:%M:%S", gmtime(sup.last_run))
-                msg = "Tot: %d Failed: %d Last run: %s Len: %s" % (
-                    sup.total_tests_n,
-                    len(sup.failing_tests),
-                    tstamp,
-                    sup.last_run_duration,
-                )
-
-        s = self._screen
-        col = 2
-
-        # TODO: refactor using menu instead of self._current_menu ?
-        if menu == 'logpane':
-            #FIXME: broken
-            for log_line in log.buffer:
-                self._print(" %s" % (log_line))
-                self.addstr(1,1," %s" % (log_line))
-            self.addstr(1,1," %s" % ('aoeu'))
-
+        if msg is None and sup.currently_running.locked():
+            msg = "Running... %d done, %d failed" % sup.runner.progress()
+        elif msg is None:
+            with sup.lock:
+                counts = (sup.total_tests_n, len(sup.failing_tests),
+                    sup.last_run, sup.last_run_duration)
+            tstamp = "--:--:--"
+            if counts[2]:
+                tstamp = strftime("%H:%M:%S", gmtime(counts[2]))
+            msg = "Tot: %d Failed: %d Last run: %s Len: %s" % (
+                counts[0], counts[1], tstamp, counts[3])
+            if sup.focus:
+                msg = "Focus " + msg
+
+        if self._logpane:
+            self._print_log()
             self._print_footer(msg)
-            s.refresh()
+            self._flush()
             return
 
         # Print tab names
-        for n in xrange(4):
-            title = self._menu[n][0]
+        col = 2
+        for n, title in enumerate(self.tabs):
             bold = (n == self._current_menu)
             self.addstr(1, col, title, bold=bold)
             col += len(title) + 2
@@ -300,19 +423,32 @@ class Screen(object):
             self._print_failing_test()
 
         self._print_footer(msg)
-        s.refresh()
+        self._flush()
 
     def handle_keypress(self):
         """Handle user input"""
         c = self._screen.getch()
+        if c == -1:
+            # timeout
+            return
+        self.refresh()
 
         # quit
         if c == ord('q'):
             self._supcut.terminate()
             raise KeyboardInterrupt
 
+        # log pane
+        elif self._logpane and c == curses.KEY_UP:
+            if self._overflow:
+                self._log_scroll += 1
+        elif self._logpane and c == curses.KEY_DOWN:
+            if self._log_scroll:
+                self._log_scroll -= 1
+
         # move between menus
         elif c == curses.KEY_LEFT:
+            self._logpane = False
             if self._current_menu:
                 self._current_menu -=1
             else:
@@ -320,7 +456,8 @@ class Screen(object):
             self._y = 0
             self._scroll = 0
         elif c == curses.KEY_RIGHT:
-            if self._current_menu < len(self._menu) - 2:
+            self._logpane = False
+            if self._current_menu < len(self.tabs) - 2:
                 self._current_menu +=1
             else:
                 self._current_menu = 0
@@ -335,9 +472,15 @@ class Screen(object):
                     self._scroll += 1
                 return
             max_y, max_x = self._screen.getmaxyx()
-            depth = len(self._menu[self._current_menu][1]) - self._scroll
-            if self._y < max_y - 7 and self._y < depth - 1:
+            depth = len(self._tab()[1]) - self._scroll
+            # visible rows, one less when scrolled to show "^^^"
+            rows = max_y - 6 - (1 if self._scroll else 0)
+            if self._y < rows - 1 and self._y < depth - 1:
                 self._y +=1
+            elif self._y < depth - 1:
+                if not self._scroll:
+                    self._y -= 1
+                self._scroll += 1
 
         elif c == curses.KEY_UP:
             # test output tab
@@ -359,24 +502,31 @@ class Screen(object):
         elif c == ord('\n'):
             if self._current_menu == 2:
                 self._current_menu = 3
+                self._y += self._scroll
+                self._scroll = 0
 
         # run test now
         elif c == ord('r'):
             self._supcut.run_test_now()
 
+        # focus on the selected failing tests
+        elif c == ord('f'):
+            self._supcut.toggle_focus()
+
         # redraw screen
         elif c == ord('d'):
-            self.refresh()
+            self._size = None
 
         # log pane
         elif c == ord('l'):
-            self.refresh(menu='logpane')
+            self._logpane = not self._logpane
+            self._log_scroll = 0
 
     def _toggle(self):
         """Toggle a menu item"""
-        title, li, selected = self._menu[self._current_menu]
+        title, li, selected = self._tab()
         try:
-            item = li[self._y]
+            item = li[self._scroll + self._y]
             selected = selected.symmetric_difference([item])
             if self._current_menu == 0:
                 if item in self._supcut.watched_selected:
@@ -428,6 +578,28 @@ class Screen(object):
 class Runner(pyinotify.ProcessEvent):
     """Run nosetests when needed"""
 
+    def my_init(self, sup=None):
+        """Called by ProcessEvent.__init__"""
+        self._sup = sup
+        self._runs = 0
+        self._file_outputs = {}  # test file -> last nosetests output
+        self._durations = {}  # test file -> last known run time
+        if isfile(self._path('durations.json')):
+            self._durations = json.load(open(self._path('durations.json')))
+        self._procs = set()  # pids of the running nosetests processes
+        self._warm = None   # queue of the idle warm workers
+        self._parsers = []  # parsers of the current run
+        # test files of a process -> (wall, cpu, max rss, timed)
+        self._usage = {}
+        self._pending = set()   # files changed since the last snapshot
+        self._bisector = None
+        self._procs_lock = Lock()
+        self._last_refresh = 0
+        self.previous = self._load_previous()
+        self._icons = {}    # icon name -> rendered pixbuf
+        self._timing = RunTimings(0, time())   # timings of the current run
+        self._event_time = 0    # spent handling events since the last run
+        self._cancelled = False
 
     def _failure_header(self, test, example):
         """Taken from nosetests, unused"""
@@ -446,164 +618,818 @@ class Runner(pyinotify.ProcessEvent):
         out.append(_indent(source))
         return '\n'.join(out)
 
+    def _path(self, *names):
+        """Return the path of a file in the .supcut directory"""
+        return join(self._sup.dir, *names)
+
+    def _log(self, msg):
+        """Log a message, tagged with the project name if supervised"""
+        log.append(self._sup.tag + msg)
+
     # nosetest related methods
 
-    def _failing(self, out):
-        """Build failing tests set and dict"""
-
-        # states: Outside, Header, Traceback, Capture, End
-        d = {}
-        state = 'O'
-        title = None
-        in_header = False
-        for line in out:
-            line = line.rstrip()
-            if state in ('O', 'C', 'T') and line == ('=' * 70):
-                state = 'H'
-            elif state == 'H' and line.startswith('FAIL: '):
-                title = line.strip()[6:]
-                d[title] = []
-            elif state == 'H' and '-' * 10 in line:
-                state = 'T'
-            elif '-' * 70 in line:
-                # after the last test output
-                state = 'E'
-            elif state == 'T':
-                if '-' * 10 in line:
-                    state = 'C'
-                elif 'File "' in line and '", line ' in line:
-                    try:
-                        fname, _1, linenum, _2, tname = line.split()[1:6]
-                    except:
-                        raise Exception, repr(line)
-                    fname = fname[1:-2]
-                    title = "%s:%s" % (fname, tname)
-                    d[title] = []
-
-                if title not in d:
-                    d[title] = []
-                d[title].append(line)
-            elif state == 'C':
-                d[title].append(line)
-
-        return frozenset(d.keys()), d
-
-    def _tot(self, out):
-        """Get total number of tests ran.
-        Returns (total, execution_time)
-        """
-        # example: "Ran 74 tests in 3.215s"
-        for line in reversed(out):
-            if line.startswith('Ran '):
-                li = line.split()
-                return (int(li[1]), li[4])
-            elif line.startswith('----'):
-                return (None, None)
-        return (None, None)
-
-    def _save_output(self, out):
+    def _parse_file(self, path):
+        """Parse a nosetests output file"""
+        parser = NoseOutputParser()
+        if isfile(path):
+            f = open(path)
+            for chunk in iter(lambda: f.read(65536), ''):
+                parser.feed(chunk)
+            f.close()
+        return parser.close()
+
+    def _load_previous(self):
+        """Load the result of the previous run. The raw output is parsed
+        only if the result was not saved yet"""
+        try:
+            return RunResult.load(self._path('results.json'))
+        except (IOError, ValueError, KeyError):
+            return self._parse_file(self._path('output'))
+
+    def _save_output(self):
         """Save new output after renaming the previous one"""
-        f = open('.supcut/output.new', 'w')
-        f.writelines(out)
+        if not isfile(self._path('output')):
+            open(self._path('output'), 'w').close()
+        rename(self._path('output'), self._path('output.old'))
+        rename(self._path('output.new'), self._path('output'))
+
+    def _copy_range(self, path, start, end, dest):
+        """Copy a byte range of a file into an open file"""
+        f = open(path)
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = f.read(min(remaining, 65536))
+            if not chunk:
+                break
+            dest.write(chunk)
+            remaining -= len(chunk)
+        f.close()
+
+    def _merge_outputs(self, units, path, run_time=None):
+        """Merge the outputs of separate nosetests runs into a single
+        output file, as if generated by one run.
+        units is a list of (output file, parser) pairs.
+        Returns the merged result.
+        """
+        start = time()
+        f = open(path, 'w')
+        # progress lines
+        for upath, parser in units:
+            self._copy_range(upath, 0, parser.sections_start, f)
+        # failure sections, moving the traces along
+        failing = {}
+        for upath, parser in units:
+            failing.update(shift_traces(parser.result.failing,
+                f.tell() - parser.sections_start))
+            self._copy_range(upath, parser.sections_start,
+                parser.sections_end, f)
+        result = RunResult.merge([parser.result for upath, parser in units],
+            run_time=run_time)
+        result.failing = failing
+        f.write('\n'.join(result.footer()) + '\n')
         f.close()
-        if not isfile('.supcut/output'):
-            open('.supcut/output', 'w').close()
-        rename('.supcut/output', '.supcut/output.old')
-        rename('.supcut/output.new', '.supcut/output')
-
-    def _get_trace(self, out, name):
-        """Extract the test failure trace related to a failing test"""
-        trace = None
-        for line in out:
-            if line == "FAIL: %s\n" % name:
-               trace = []
-            elif trace != None:
-                if line.startswith('=' * 10):
-                    return trace
-                trace.append(line.strip())
-        if trace:
-            return trace
-        return []
-
-
-    def run_nose(self, fname):
-        """Run nosetests, collects output"""
-        global supcut
-        if not supcut.test_files_selected:
-            supcut.screen.refresh(msg='No test files selected')
+        self._timing.add('merge', start)
+        return result
+
+    def _run_files(self, test_files, path):
+        """Run nosetests on a list of test files, parsing the output while
+        it is being written into path. Returns the parser.
+        """
+        args = [self._sup.conf.nose_opts] + list(test_files)
+        xunit = self._sup.conf.ingest == 'xunit'
+        if xunit:
+            args.append("--with-xunit --xunit-file=%s.xml" % path)
+        parser = NoseOutputParser()
+        with self._procs_lock:
+            self._parsers.append(parser)
+        timing = self._timing
+        tid = current_thread().ident
+        spawned = time()
+
+        started = None
+        if self._warm:
+            started = self._start_warm(args, path)
+        if started is None:
+            # run in a new process group to be able to kill its children
+            p = Popen("nosetests %s" % ' '.join(args), shell=True,
+                bufsize=4096, stdout=PIPE, stderr=STDOUT, close_fds=True,
+                preexec_fn=setsid, cwd=self._sup.root)
+
+            def wait():
+                # the usage includes the children waited by the shell
+                usage = wait4(p.pid, 0)[2]
+                return usage.ru_utime + usage.ru_stime, usage.ru_maxrss
+
+            started = p.pid, p.stdout.fileno(), wait
+        pid, fd, wait = started
+        forked = time()
+        timing.add('spawn', spawned, forked, tid=tid)
+
+        with self._procs_lock:
+            self._procs.add(pid)
+            if self._cancelled:
+                self._kill(pid)
+        f = open(path, 'w')
+        try:
+            for chunk in iter(lambda: read(fd, 65536), ''):
+                f.write(chunk)
+                t = time()
+                parser.feed(chunk)
+                timing.accumulate('parse', time() - t)
+                self._show_progress()
+        finally:
+            f.close()
+            usage = wait()
+            timing.add('tests', forked, tid=tid)
+            with self._procs_lock:
+                self._procs.discard(pid)
+        parser.close()
+        if xunit and not self._cancelled:
+            with timing.span('ingest', tid=tid):
+                self._ingest_xunit(parser, path + '.xml')
+        if usage:
+            cpu, max_rss = usage
+            timed = any(dur is not None
+                for status, dur in parser.result.tests.itervalues())
+            with self._procs_lock:
+                self._usage[tuple(test_files)] = (time() - spawned, cpu,
+                    max_rss, timed)
+        return parser
+
+    def _usage_units(self, usage):
+        """Key the usage of the nosetests processes by baseline unit: the
+        test file when a process ran a single one, the full run for the
+        shards. The processes running test addresses, changing from run to
+        run, are merged under None.
+        """
+        units = {}
+        for files, u in usage.iteritems():
+            if [tf for tf in files if ':' in tf]:
+                unit = None
+            elif len(files) == 1:
+                unit = files[0]
+            else:
+                unit = 'full run'
+            if unit in units:
+                wall, cpu, max_rss, timed = units[unit]
+                u = (max(wall, u[0]), cpu + u[1], max(max_rss, u[2]),
+                    timed and u[3])
+            units[unit] = u
+        return units
+
+    def start_warm(self, n, preload):
+        """Start n warm workers"""
+        self._warm = Queue()
+        for i in xrange(n):
+            self._warm.put(WarmWorker(preload, cwd=self._sup.root))
+
+    def stop_warm(self):
+        """Terminate the warm workers"""
+        while self._warm and not self._warm.empty():
+            self._warm.get().stop()
+
+    def _start_warm(self, args, path):
+        """Start a run on a warm worker, reading the output from a fifo.
+        Returns (pid, fd, wait function) or None if the worker died.
+        """
+        sup = self._sup
+        worker = self._warm.get()
+        argv = ['nosetests'] + shlex.split(' '.join(args))
+        fifo = path + '.fifo'
+        if exists(fifo):
+            unlink(fifo)
+        mkfifo(fifo)
+        # the worker opens the write end before forking the child, which
+        # must not be waited for: if the child dies early, reading it
+        # returns EOF
+        fd = os_open(fifo, O_RDONLY | O_NONBLOCK)
+        try:
+            pid = worker.start(argv, fifo)
+        except (IOError, ValueError), e:
+            self._log("%s, starting a new one" % e)
+            worker.stop()
+            self._warm.put(WarmWorker(
+                sup.conf.preload.split(), cwd=sup.root))
+            close(fd)
+            unlink(fifo)
+            return None
+        fcntl(fd, F_SETFL, fcntl(fd, F_GETFL) & ~O_NONBLOCK)
+
+        def wait():
+            close(fd)
+            unlink(fifo)
+            try:
+                status, cpu, max_rss = worker.wait()
+                self._warm.put(worker)
+                return cpu, max_rss
+            except (IOError, ValueError), e:
+                self._log("%s, starting a new one" % e)
+                self._warm.put(WarmWorker(
+                    sup.conf.preload.split(), cwd=sup.root))
+
+        return pid, fd, wait
+
+    def _ingest_xunit(self, parser, path):
+        """Replace the result scraped from the text output with the
+        one read from the xunit file, if available"""
+        try:
+            result = parse_xunit(path)
+        except (IOError, SyntaxError), e:
+            self._log("unable to read %s: %s" % (path, e))
             return
+        # point to the traces in the text output where possible
+        records = dict((split_test_name(name) or name, trace)
+            for name, trace in parser.result.failing.iteritems())
+        for name in result.failing:
+            trace = records.get(split_test_name(name) or name)
+            if trace is not None:
+                result.failing[name] = trace
+        # the total run time includes setup and teardown
+        if parser.result.run_time is not None:
+            result.run_time = parser.result.run_time
+        result.progress = parser.result.progress
+        result.progress_failed = parser.result.progress_failed
+        parser.result = result
+
+    def progress(self):
+        """Return the number of tests completed and failed
+        in the current run"""
+        with self._procs_lock:
+            done = sum(p.result.progress for p in self._parsers)
+            failed = sum(p.result.progress_failed for p in self._parsers)
+        return done, failed
+
+    def _show_progress(self):
+        """Refresh the screen at most twice per second"""
+        if time() > self._last_refresh + .5:
+            self._last_refresh = time()
+            self._sup.screen.refresh()
+            done, failed = self.progress()
+            self._sup.publish('progress', done=done, failed=failed)
+
+    def _kill(self, pid):
+        """Kill a nosetests process group"""
+        try:
+            killpg(pid, SIGTERM)
+        except OSError:
+            pass
 
-        # Avoid running tests too frequently
-        if supcut.last_run:
-            if time() < supcut.last_run + 10:
-                return
+    def reset(self):
+        """Clear the cancellation of the previous run"""
+        with self._procs_lock:
+            self._cancelled = False
+
+    def cancel(self):
+        """Kill the running nosetests processes, the results of the
+        current run are discarded"""
+        with self._procs_lock:
+            self._cancelled = True
+            for pid in self._procs:
+                self._kill(pid)
+        self._log('cancelling run')
+
+    def _shards(self, test_files, n):
+        """Split the test files in up to n shards having similar
+        expected run time, based on the previous runs"""
+        known = [self._durations[tf] for tf in test_files
+            if tf in self._durations]
+        default = sum(known) / len(known) if known else 1.0
+        shards = [[] for i in xrange(n)]
+        loads = [0.0] * n
+        # longest first, each on the least loaded shard
+        for tf in sorted(test_files,
+                key=lambda tf: -self._durations.get(tf, default)):
+            i = loads.index(min(loads))
+            shards[i].append(tf)
+            loads[i] += self._durations.get(tf, default)
+        # keep the given order inside each shard
+        position = dict((tf, n) for n, tf in enumerate(test_files))
+        return [sorted(shard, key=position.get) for shard in shards if shard]
+
+    def _address(self, name, test_files):
+        """Build the nose address of a test in one of the test files,
+        e.g. test/test_mod.py:TestCase.test_x"""
+        split = split_test_name(name)
+        if split is None:
+            return None
+        module, attr = split
+        for tf in test_files:
+            if not tf.endswith('.py'):
+                continue
+            dotted = tf[:-3].replace(sep, '.')
+            if dotted == module or dotted.endswith('.' + module):
+                return "%s:%s" % (tf, attr)
+        return None
+
+    def _file_durations(self, test_files):
+        """Return the run time of the test files, summing the average
+        durations of their tests when recorded in the history, else the
+        last run time of the files"""
+        durations = dict(self._durations)
+        if not self._sup.history:
+            return durations
+        modules = {}    # dotted module name and its suffixes -> test file
+        for tf in test_files:
+            if tf.endswith('.py'):
+                parts = tf[:-3].split(sep)
+                for i in xrange(len(parts)):
+                    modules.setdefault('.'.join(parts[i:]), tf)
+        summed = {}
+        for name, dur in self._sup.history.durations().iteritems():
+            split = split_test_name(name)
+            tf = split and modules.get(split[0])
+            if tf:
+                summed[tf] = summed.get(tf, 0) + dur
+        durations.update(summed)
+        return durations
+
+    def _run_failing_first(self, test_files):
+        """Run the previously failing tests of the given test files before
+        the others, notifying the fixed ones straight away.
+        Returns their names.
+        """
+        addresses = {}
+        for name in self.previous.failing:
+            address = self._address(name, test_files)
+            if address:
+                addresses[address] = name
+        if not addresses:
+            return set()
+
+        parser = self._run_files(sorted(addresses),
+            self._path('out', 'failing'))
+        result = parser.result
+        names = set(addresses.itervalues())
+        if self._cancelled:
+            return set()
+        if result.tot != len(addresses) or set(result.failing) - names:
+            # some address was not resolved as expected, e.g. a test
+            # with a docstring: wait for the full run
+            self._log('unable to run the failing tests first')
+            return set()
+
+        fixed = names - set(result.failing)
+        for name in fixed:
+            self._sup.dispatcher.post('fixed', name)
+        self._sup.dispatcher.flush()
+        msg = "%d fixed, %d still failing" % (len(fixed),
+            len(names) - len(fixed))
+        self._log(msg)
+        self._sup.screen.refresh(msg="%s. Running..." % msg)
+        return fixed
+
+    def _run_focus(self, test_files):
+        """Run the selected failing tests only, notifying the fixed ones
+        and the ones failing again. Returns the names of the ones still
+        failing, or None if they cannot be run alone.
+        """
+        sup = self._sup
+        with sup.lock:
+            names = sup.failing_tests_selected & set(sup.failing_tests)
+        addresses = {}
+        for name in names:
+            address = self._address(name, test_files)
+            if address is None:
+                self._log('unable to focus on %s' % name)
+                return None
+            addresses[address] = name
+        if not addresses:
+            return None
 
-        supcut.currently_running.acquire()
-        supcut.watched_changed = fname
         start_time = time()
-        log.append('starting nose')
-        supcut.screen.refresh()
-
-        cmd = "nosetests %s %s" % (
-            supcut.conf.nose_opts,
-            ' '.join(supcut.test_files_selected),
-        )
-        p = Popen(cmd, shell=True, bufsize=4096,
-            stdout=PIPE, stderr=STDOUT, close_fds=True)
-        out = p.stdout.readlines()
-        self._save_output(out)
-
-        tot, run_time = self._tot(out)
-        failing, failing_dict = self._failing(out)
-
-        old = open('.supcut/output.old').readlines()
-        failing_old, failing_old_dict = self._failing(old)
-        tot_old, old_run_time = self._tot(old)
-        if (tot_old, old_run_time) == (None, None):
-            tot_old = 0
-            old_run_time = 0
+        path = self._path('out', 'focus')
+        if isfile(path):
+            # the traces of the previous focus run map the old file
+            unlink(path)
+        parser = self._run_files(sorted(addresses), path)
+        result = parser.result
+        if self._cancelled:
+            return None
+        if result.tot != len(addresses) or set(result.failing) - names:
+            self._log('unable to run the focused tests alone')
+            return None
+
+        failing = set(result.failing)
+        traces = Traces(path, result.failing)
+        with sup.lock:
+            fixed = names - failing - sup.focus_fixed
+            broken = failing & sup.focus_fixed
+            sup.focus_fixed = (sup.focus_fixed | fixed) - broken
+            base = getattr(sup.failing_tests_dict, 'base',
+                sup.failing_tests_dict)
+            sup.failing_tests_dict = LayeredTraces(traces, base)
+            sup.last_run = start_time
+            if result.run_time is not None:
+                sup.last_run_duration = "%.3fs" % result.run_time
+        for name in fixed:
+            sup.dispatcher.post('fixed', name)
+        for name in broken:
+            sup.dispatcher.post('failing', name,
+                traces[name] if sup.dispatcher.needs_traces else None)
+        sup.dispatcher.flush()
+        msg = "Focus: %d passing, %d failing" % (len(names) - len(failing),
+            len(failing))
+        self._log(msg)
+        sup.publish('focus_finished', passing=sorted(names - failing),
+            failing=sorted(failing))
+        sup.screen.refresh(msg=msg)
+        return failing
+
+    def _run_units(self, units, paths):
+        """Run nosetests on each unit (a list of test files) using up to
+        conf.workers parallel processes, saving the outputs in paths.
+        Returns the parsers in order.
+        """
+        parsers = [None] * len(units)
+        workers = min(self._sup.conf.workers, len(units))
+        with self._procs_lock:
+            self._parsers = []
+        if workers <= 1:
+            for i, unit in enumerate(units):
+                if not self._cancelled:
+                    parsers[i] = self._run_files(unit, paths[i])
+        else:
+            queue = Queue()
+            for item in enumerate(units):
+                queue.put(item)
 
-        new_failing = failing - failing_old
-        fixed = failing_old - failing
-        tot_diff = tot - tot_old
+            def worker():
+                while True:
+                    try:
+                        i, unit = queue.get_nowait()
+                    except Empty:
+                        return
+                    if self._cancelled:
+                        return
+                    parsers[i] = self._run_files(unit, paths[i])
+
+            threads = [Thread(target=worker) for i in xrange(workers)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+        if self._cancelled:
+            return parsers
+
+        # update the run time of each test file
+        for unit, parser in zip(units, parsers):
+            run_time = parser.result.run_time
+            if run_time is not None:
+                for tf in unit:
+                    self._durations[tf] = run_time / len(unit)
+        f = open(self._path('durations.json'), 'w')
+        json.dump(self._durations, f)
+        f.close()
+        return parsers
+
+    def _affected(self, test_files, changed):
+        """Return the test files affected by the changes in impact
+        analysis mode, all of them every full_run_every runs or when the
+        changes cannot be analysed"""
+        sup = self._sup
+        impact = sup.impact
+        self._runs += 1
+        every = sup.conf.full_run_every
+        full = impact is None or None in changed \
+            or [fn for fn in changed if not fn.endswith('.py')] \
+            or (every and self._runs % every == 0) \
+            or [tf for tf in test_files if tf not in self._file_outputs]
+        if full:
+            self._log('full run')
+            return list(test_files)
+        affected = impact.affected(test_files, changed)
+        self._log('%d test files affected' % len(affected))
+        return affected
+
+    def _run_per_file(self, test_files, affected, changed):
+        """Run each affected test file in its own nosetests process,
+        reusing the previous output of the other test files, and the
+        cached result of the ones having one.
+        Returns the merged result, or None if cancelled.
+        Sets the result of the executed tests and the tests depending on
+        the changes in self._executed and self._related.
+        """
+        sup = self._sup
+        impact = sup.impact
+        cache = sup.result_cache
+        keys = {}
+        if cache:
+            hits = []
+            context = cache.context("%s\0%s" % (sup.conf.nose_opts,
+                sup.conf.ingest), [fn for fn in list(sup.watched)
+                    if not fn.endswith('.py')])
+            for tf in affected:
+                keys[tf] = cache.key(tf, context)
+                entry = None
+                # a run requested by the user reruns everything
+                if not sup.cli_opts.no_cache and None not in changed:
+                    entry = cache.get(keys[tf])
+                if entry:
+                    self._file_outputs[tf] = entry
+                    hits.append(tf)
+            affected = [tf for tf in affected if tf not in hits]
+            self._log('%d cached test files' % len(hits))
+
+        paths = [self._path('out', tf.replace(sep, '%')) for tf in affected]
+        parsers = self._run_units([[tf] for tf in affected], paths)
+        if self._cancelled:
+            return None
+        # the outputs to be merged must survive the cache eviction
+        keep = set(output for output, p in self._file_outputs.itervalues())
+        for tf, path, parser in zip(affected, paths, parsers):
+            if cache:
+                self._file_outputs[tf] = cache.put(keys[tf], path, parser,
+                    keep=keep)
+                keep.add(self._file_outputs[tf][0])
+            else:
+                self._file_outputs[tf] = (path, parser)
 
-        for name in fixed:
-#            send_email(conf, 'success', name, []) FIXME
-            self._send_osd(name, 'Test fixed!', icon='success')
+        real = [fn for fn in changed if fn is not None]
+        if impact is None or [fn for fn in real if not fn.endswith('.py')]:
+            related_files = set(affected) if real else set()
+        else:
+            related_files = set(impact.affected(affected, real))
+        self._executed = RunResult.merge([p.result for p in parsers])
+        self._related = set()
+        for tf, parser in zip(affected, parsers):
+            if tf in related_files:
+                self._related.update(parser.result.tests)
+                self._related.update(parser.result.failing)
+        if impact:
+            impact.save()
+        if cache:
+            cache.save()
+        return self._merge_outputs([self._file_outputs[tf]
+            for tf in test_files], self._path('output.new'))
+
+    def run_nose(self, changed):
+        """Run nosetests, collects output.
+        changed is the set of modified files, None in it requests a full run
+        """
+        sup = self._sup
+        if not sup.test_files_selected:
+            sup.screen.refresh(msg='No test files selected')
+            return
 
-        for name in new_failing:
-            trace = self._get_trace(out, name)
-#            send_email(conf, 'failure', name, trace)
-            self._send_osd( name, 'Failing test', icon='failure')
+        sup.currently_running.acquire()
+        try:
+            self._run(changed)
+        except Exception, e:
+            self._log("run failed: %s" % e)
+        finally:
+            sup.watched_changed = set()
+            sup.currently_running.release()
+            sup.screen.refresh()
+
+    def _run(self, changed):
+        """Run the tests and collect the results, holding the running
+        lock"""
+        sup = self._sup
+        sup.watched_changed = changed
+        start_time = time()
+        timing = self._timing = sup.timings.start(
+            sup.scheduler.burst_started or start_time)
+        timing.accumulate('event', self._event_time)
+        self._event_time = 0
+        timing.add('debounce', timing.started, start_time)
+        self._log('starting nose')
+        if sup.snapshot:
+            self._pending.update(fn for fn in changed if fn is not None)
+        sup.publish('run_started',
+            changed=sorted(f for f in changed if f is not None))
+        sup.screen.refresh()
+
+        if not isdir(self._path('out')):
+            makedirs(self._path('out'))
+        test_files = [tf for tf in sup.test_files
+            if tf in sup.test_files_selected]
+        if sup.focus and None not in changed:
+            still_failing = self._run_focus(test_files)
+            if still_failing:
+                if sup.hashes:
+                    sup.hashes.save()
+                sup.dispatcher.flush(timing)
+                return
+            if still_failing is not None:
+                self._log('focused tests passing, running all the tests')
+                sup.screen.refresh(msg="Focused tests passing. Running...")
+        self._executed = self._related = None
+        with self._procs_lock:
+            self._usage = {}
+        per_file = sup.impact or sup.result_cache
+        affected = test_files
+        if per_file:
+            affected = self._affected(test_files, changed)
+            if not affected:
+                sup.publish('run_skipped')
+                sup.dispatcher.flush(timing)
+                return
+        early_fixed = set()
+        with sup.lock:
+            focus_fixed = set(sup.focus_fixed)
+        if sup.conf.order == 'failfirst':
+            early_fixed = self._run_failing_first(affected)
+            # fastest first
+            durations = self._file_durations(test_files)
+            test_files.sort(key=lambda tf: durations.get(tf, 0))
+            affected.sort(key=lambda tf: durations.get(tf, 0))
+        if per_file:
+            result = self._run_per_file(test_files, affected, changed)
+        else:
+            shards = self._shards(test_files, sup.conf.workers)
+            paths = [self._path('out', 'shard.%d' % i)
+                for i in xrange(len(shards))]
+            parsers = self._run_units(shards, paths)
+            if self._cancelled:
+                result = None
+            elif len(parsers) == 1:
+                rename(paths[0], self._path('output.new'))
+                result = parsers[0].result
+            else:
+                result = self._merge_outputs(zip(paths, parsers),
+                    self._path('output.new'), run_time=time() - start_time)
+
+        if result is None:
+            sup.publish('run_cancelled')
+            if early_fixed:
+                # already notified as fixed
+                for name in early_fixed:
+                    self.previous.failing.pop(name, None)
+                self.previous.save(self._path('results.json'))
+            sup.dispatcher.flush(timing)
+            return
 
-        if tot_diff > 0:
-            self._send_osd('New test', "%s test added" % tot_diff, icon='success')
-        elif tot_diff < 0:
-            self._send_osd('Test removed', "%s test removed" % -tot_diff, icon='success')
+        diff_start = time()
+        self._save_output()
+
+        tot = result.tot or 0
+        failing = frozenset(result.failing)
 
-        with supcut.lock:
-            supcut.failing_tests = list(failing)
-            supcut.failing_tests_dict = failing_dict
-            supcut.failing_tests_selected = set(failing)
-            supcut.total_tests_n = tot
-            supcut.last_run = start_time
-            supcut.last_run_duration = run_time
+        old = self.previous
+        # the names differ between the text and xunit ingest modes
+        current = dict((canonical_test_name(name), name) for name in failing)
+        failing_old = frozenset(current.get(canonical_test_name(name), name)
+            for name in old.failing)
+        tot_old = old.tot or 0
+        self.previous = result
+        result.save(self._path('results.json'))
+        traces = Traces(self._path('output'), result.failing)
 
-        supcut.watched_changed = None
-        supcut.currently_running.release()
-        supcut.screen.refresh()
+        new_failing = failing - failing_old
+        fixed = failing_old - failing
+        tot_diff = tot - tot_old
+        timing.add('diff', diff_start)
+        if sup.snapshot:
+            self._check_culprits(new_failing, test_files)
+
+        for name in fixed - early_fixed - focus_fixed:
+            sup.dispatcher.post('fixed', name)
+        # notified as fixed by the failfirst or focus runs
+        for name in new_failing | ((early_fixed | focus_fixed) & failing):
+            sup.dispatcher.post('failing', name,
+                traces[name] if sup.dispatcher.needs_traces else None)
+        if tot_diff > 0:
+            sup.dispatcher.post('added', tot_diff)
+        elif tot_diff < 0:
+            sup.dispatcher.post('removed', -tot_diff)
+
+        with self._procs_lock:
+            usage = self._usage_units(self._usage)
+        if usage:
+            self._log("cpu %.3fs, peak rss %dMB" % (
+                sum(u[1] for u in usage.itervalues()),
+                max(u[2] for u in usage.itervalues()) / 1024))
+        if sup.history:
+            with timing.span('history'):
+                run_id, regressions = sup.history.record(start_time,
+                    time() - start_time, self._executed or result, changed,
+                    related=self._related, passed=fixed, usage=usage)
+            for category, name, detail in regressions:
+                self._log("%s %s: %s" % (category, name, detail))
+                sup.dispatcher.post(category, name, detail)
+        if sup.archive:
+            with timing.span('archive'):
+                sup.archive.store(start_time, self._path('output'), result)
 
+        with sup.lock:
+            if sup.focus:
+                # the tests left out of focus stay out
+                deselected = set(sup.failing_tests) - \
+                    sup.failing_tests_selected
+                sup.failing_tests_selected = set(failing) - deselected
+            else:
+                sup.failing_tests_selected = set(failing)
+            sup.failing_tests = list(failing)
+            sup.failing_tests_dict = traces
+            sup.focus_fixed = set()
+            if sup.culprit_tests.isdisjoint(failing):
+                # the broken tests are fixed
+                sup.culprit = None
+                sup.culprit_tests = set()
+            sup.total_tests_n = tot
+            sup.last_run = start_time
+            if result.run_time is not None:
+                sup.last_run_duration = "%.3fs" % result.run_time
+
+        if sup.hashes:
+            sup.hashes.save()
+        sup.dispatcher.flush(timing)
+        sup.publish('run_finished', total_tests_n=tot,
+            failing_tests=sorted(failing), new_failing=sorted(new_failing),
+            fixed=sorted(fixed), duration=time() - start_time)
+
+
+    def _check_culprits(self, new_failing, test_files):
+        """Start searching the changes breaking the newly failing tests
+        when many files changed, then snapshot the changed files"""
+        sup = self._sup
+        pending, self._pending = self._pending, set()
+        prefix = sup.root + sep
+        changes = {}
+        for fname in pending:
+            old, new = sup.snapshot.get(fname), read_file(fname)
+            if old != new and fname.startswith(prefix):
+                changes[fname] = (old, new)
+        sup.snapshot.update(pending)
+        sup.snapshot.save()
+        if not new_failing or len(changes) < 2:
+            return
+        names = sorted(new_failing)
+        addresses = [self._address(name, test_files) for name in names]
+        if None in addresses:
+            self._log('unable to bisect: some failing tests cannot be '
+                'run alone')
+            return
+        self.stop_bisect()
+        with sup.lock:
+            sup.culprit = None
+            sup.culprit_tests = set()
+        self._bisector = Bisector(sup.root, sup.conf.nose_opts,
+            log=self._log)
+        t = Thread(target=self._bisect,
+            args=(self._bisector, changes, names, addresses))
+        t.daemon = True
+        t.start()
+
+    def _bisect(self, bisector, changes, names, addresses):
+        """Search the culprits and report them"""
+        sup = self._sup
+        self._log('bisecting %d changes' % len(changes))
+        sup.screen.refresh(msg="Bisecting %d changes..." % len(changes))
+        start = time()
+        culprits = bisector.run(changes, addresses)
+        files = culprits and [relpath(fname, sup.root) for fname in culprits]
+        with sup.lock:
+            # a newer bisection resets the culprit, a newer run may have
+            # fixed the tests
+            if files and not bisector.cancelled and \
+                    set(names).intersection(sup.failing_tests):
+                sup.culprit = files
+                sup.culprit_tests = set(names)
+            else:
+                files = None
+        if files is None:
+            sup.screen.refresh()
+            return
+        self._log("%s broke %s (%d runs in %.3fs)" % (', '.join(files),
+            ', '.join(names), bisector.probes, time() - start))
+        sup.dispatcher.post('culprit', ', '.join(files),
+            "broke %s" % ', '.join(names))
+        sup.dispatcher.flush()
+        sup.publish('culprit', files=files, tests=names)
+        sup.screen.refresh()
+
+    def stop_bisect(self):
+        """Stop searching the culprits"""
+        if self._bisector:
+            self._bisector.cancel()
 
     def process_default(self, event):
         """Run nose when any monitored file has been modified"""
-        fname = event.pathname
-        if fname not in supcut.watched_selected:
+        sup = self._sup
+        t = time()
+        if event.dir or event.mask & pyinotify.IN_CREATE:
+            # new files are picked up when written
             return
-        if event.maskname in ('IN_OPEN', 'IN_ACCESS', 'IN_CLOSE_NOWRITE'):
+        fname = event.pathname
+        if fname not in sup.watched_selected:
+            if fname in sup.watched_set or sup.index is None \
+                    or not sup.index.match(fname):
+                return
+            sup.add_watched(fname)
+
+        if sup.hashes and not sup.hashes.changed(fname):
+            self._log("%s on %s, unchanged" % (event.maskname, fname))
             return
 
-        log.append("%s on %s" % (event.maskname, fname))
-        self.run_nose(fname)
+        self._log("%s on %s" % (event.maskname, fname))
+        self._event_time += time() - t
+        if sup.focus:
+            sup.scheduler.notify(fname, delay=sup.conf.focus_quiet_period)
+        else:
+            sup.scheduler.notify(fname)
 
 
     # OSD related methods
@@ -612,21 +1438,33 @@ class Runner(pyinotify.ProcessEvent):
         """Notify the user using OSD"""
         if not osd_available:
             return
+        gtk.gdk.threads_enter()
+        try:
+            self._show_osd(title, s, icon)
+        finally:
+            gtk.gdk.threads_leave()
+
+    def _show_osd(self, title, s, icon):
+        """Show an OSD notification, holding the GTK lock"""
         n = osd.Notification(str(title), s)
         #n.set_urgency(osd.URGENCY_NORMAL)
         #n.set_timeout(osd.EXPIRES_NEVER)
         #n.add_action("clicked","Button text", callback_function, None)
-        helper = gtk.Button()
         #        icon = gtk.gdk.pixbuf_new_from_file(RESOURCES + "audio-x-generic.png")
 
-        if icon == 'success':
-            i = helper.render_icon(gtk.STOCK_YES, gtk.ICON_SIZE_DIALOG)
-        elif icon == 'failure':
-            i = helper.render_icon(gtk.STOCK_NO, gtk.ICON_SIZE_DIALOG)
-        elif icon == 'new_test':
-            i = helper.render_icon(gtk.STOCK_ADD, gtk.ICON_SIZE_DIALOG)
-        else:
-            i = helper.render_icon(gtk.STOCK_GO_FORWARD, gtk.ICON_SIZE_DIALOG)
+        i = self._icons.get(icon)
+        if i is None:
+            helper = gtk.Button()
+            if icon == 'success':
+                i = helper.render_icon(gtk.STOCK_YES, gtk.ICON_SIZE_DIALOG)
+            elif icon == 'failure':
+                i = helper.render_icon(gtk.STOCK_NO, gtk.ICON_SIZE_DIALOG)
+            elif icon == 'new_test':
+                i = helper.render_icon(gtk.STOCK_ADD, gtk.ICON_SIZE_DIALOG)
+            else:
+                i = helper.render_icon(gtk.STOCK_GO_FORWARD,
+                    gtk.ICON_SIZE_DIALOG)
+            self._icons[icon] = i
 
         n.set_icon_from_pixbuf(i)
         n.show()
@@ -636,20 +1474,37 @@ class Runner(pyinotify.ProcessEvent):
 
 class Supcut(object):
 
-    def __init__(self):
-        """Read configuration, setup Inotify watching"""
+    def __init__(self, root='.', cli_opts=None, wm=None, limiter=None,
+            screen=None, name=None):
+        """Read configuration, setup Inotify watching.
+        A supervisor passes its shared WatchManager, run limiter and
+        screen, and a name to tag the log messages of the project.
+        """
+        self.root = abspath(root)
+        self.dir = join(self.root, '.supcut')
+        self.tag = "[%s] " % name if name else ''
+        self._supervised = wm is not None
         # shared test attrs
         self.currently_running = Lock()
         self.watched = []
         self.total_tests_n = 0
         self.failing_tests = []
         self.failing_tests_selected = set()
+        self.culprit = None     # changed files breaking the tests
+        self.culprit_tests = set()  # the tests they break
+        self.focus = False      # run only the selected failing tests
+        self.focus_fixed = set()    # fixed by the focus runs
         self.last_run = None
         self.last_run_duration = '--.---s'
         self.test_files = []
 
         self.lock = Lock()
-        self.conf = Conf()
+        self.conf = Conf(self.root)
+        self.cli_opts = cli_opts or parse_args()[0]
+        if not self._supervised:
+            if self.cli_opts.daemon:
+                # before starting any thread
+                daemonize()
 
         if self.conf.send_osd_notifications and not osd_available:
             print "send_osd_notifications is set to True in the configuration " \
@@ -659,32 +1514,151 @@ class Supcut(object):
 
         self.test_files = self.conf.test_files.split(' ')
         self.test_files_selected = set(self.test_files)
-        self.cli_opts = self._parse_args()
 
         if self.conf.send_osd_notifications and not osd_available:
             raise Exception, """gtk and/or pynotify are required \
 to show OSD notifications. Install the modules or disable \
 send_osd_notifications in the configuration file"""
 
-        self._wm = pyinotify.WatchManager()
-        self._notifier = pyinotify.ThreadedNotifier(self._wm, default_proc_fun=Runner())
+        self.impact = None
+        if self.conf.impact_analysis:
+            self.impact = ImpactGraph(join(self.dir, 'impact.json'),
+                root=self.root)
+        self.history = None
+        if self.conf.history:
+            self.history = History(join(self.dir, 'history.db'),
+                slower_factor=self.conf.slower_factor,
+                slower_min=self.conf.slower_min,
+                memory_factor=self.conf.memory_factor,
+                memory_min=self.conf.memory_min * 1024)
+        self.archive = None
+        if self.conf.archive:
+            self.archive = Archive(join(self.dir, 'archive.db'),
+                keep_runs=self.conf.archive_runs,
+                keep_days=self.conf.archive_days)
+
+        self.timings = Timings(jsonl_path=self.conf.timings_log or None,
+            trace_path=self.conf.timings_trace or None)
+        self.runner = Runner(sup=self)
+        self.dispatcher = Dispatcher(
+            osd=self.runner._send_osd if osd_available else None,
+            mailer=Mailer(self.conf) if self.conf.email_server else None,
+            timings=self.timings, log=log, prefix=self.tag)
+        previous = self.runner.previous
+        self.failing_tests = list(previous.failing)
+        self.failing_tests_dict = Traces(join(self.dir, 'output'),
+            previous.failing)
+        self.failing_tests_selected = set(previous.failing)
+        self.total_tests_n = previous.tot or 0
+        if self.conf.warm_workers:
+            self.runner.start_warm(self.conf.workers,
+                self.conf.preload.split())
+        self.scheduler = Scheduler(self.runner.run_nose,
+            quiet_period=self.conf.quiet_period,
+            cancel=self.runner.cancel if self.conf.preempt else None,
+            limiter=limiter, reset=self.runner.reset)
+        self._notifier = None
+        if wm is None:
+            wm = pyinotify.WatchManager()
+            self._notifier = pyinotify.ThreadedNotifier(wm)
+        self._wm = wm
 
         self.watched = []
-        from glob import iglob
-        import os.path
-        for wfname in self.conf.files.split(' '):
-            wfname = wfname.strip()
-            for fname in iglob(wfname):
-                fname = os.path.abspath(fname)
-                dirname = os.path.dirname(fname)
-                # Setup watching at directory level
-                self._wm.add_watch(dirname, pyinotify.ALL_EVENTS, rec=False)
-                self.watched.append(fname)
-
+        self.index = None
+        if self.conf.recursive:
+            self.index = PathIndex(self.root, self.conf.files.split(),
+                self.conf.exclude.split())
+            self._wm.add_watch(self.index.root, WATCH_MASK,
+                proc_fun=self.runner, rec=True, auto_add=True,
+                exclude_filter=self.index.excluded_dir)
+            self.watched = self.index.scan()
+        else:
+            from glob import iglob
+            import os.path
+            for wfname in self.conf.files.split(' '):
+                wfname = wfname.strip()
+                if not wfname:
+                    continue
+                for fname in iglob(join(self.root, wfname)):
+                    fname = os.path.abspath(fname)
+                    dirname = os.path.dirname(fname)
+                    # Setup watching at directory level
+                    self._wm.add_watch(dirname, WATCH_MASK,
+                        proc_fun=self.runner, rec=False)
+                    self.watched.append(fname)
+
+        self.watched_set = set(self.watched)
         self.watched_selected = set(self.watched)
-        self.watched_changed = None
 
-        self.screen = Screen(parent=self)
+        self.hashes = None
+        if self.conf.skip_noop_writes:
+            self.hashes = HashCache(join(self.dir, 'hashes.json'),
+                normalize=self.conf.ignore_cosmetic)
+            self.hashes.prime(self.watched)
+            self.hashes.save()
+
+        self.snapshot = None
+        if self.conf.bisect:
+            self.snapshot = Snapshot(join(self.dir, 'snapshot'))
+            self.snapshot.update([fn for fn in self.watched
+                if not self.snapshot.known(fn)])
+            self.snapshot.save()
+
+        self.result_cache = None
+        if self.conf.result_cache:
+            self.result_cache = ResultCache(self.impact or ImpactGraph(
+                    join(self.dir, 'impact.json'), root=self.root),
+                self.hashes or HashCache(join(self.dir, 'hashes.json'),
+                    normalize=self.conf.ignore_cosmetic),
+                path=join(self.dir, 'cache'),
+                size=self.conf.result_cache_size)
+        self.watched_changed = set()
+
+        headless = self.cli_opts.headless or self.cli_opts.daemon
+        self.server = None
+        if self.conf.socket or headless:
+            self.server = ControlServer(self, join(self.dir, 'socket'))
+        if screen is not None:
+            self.screen = screen
+        elif headless:
+            self.screen = HeadlessScreen(parent=self,
+                echo=not self.cli_opts.daemon, prefix=self.tag)
+            if not self._supervised:
+                signal(SIGTERM, lambda signum, frame: self.screen.stop())
+        else:
+            self.screen = Screen(parent=self)
+
+    def status(self):
+        """Describe the current state"""
+        done, failed = self.runner.progress()
+        with self.lock:
+            return dict(
+                running=self.currently_running.locked(),
+                done=done,
+                failed=failed,
+                total_tests_n=self.total_tests_n,
+                failing_tests=list(self.failing_tests),
+                last_run=self.last_run,
+                last_run_duration=self.last_run_duration,
+                changed=sorted(f for f in self.watched_changed if f),
+                culprit=self.culprit,
+                focus=self.focus,
+            )
+
+    def publish(self, event, **kw):
+        """Send an event to the socket subscribers"""
+        if self.server:
+            kw['event'] = event
+            kw['time'] = time()
+            self.server.publish(kw)
+
+    def add_watched(self, fname):
+        """Watch a new file"""
+        with self.lock:
+            self.watched.append(fname)
+            self.watched_set.add(fname)
+            self.watched_selected.add(fname)
+        log.append("watching new file %s" % fname)
 
     def enable_watch(self, fname):
         self.watched_selected.add(fname)
@@ -692,18 +1666,6 @@ send_osd_notifications in the configuration file"""
     def disable_watch(self, fname):
         self.watched_selected.remove(fname)
 
-    def _parse_args(self):
-        """Parse command-line args"""
-        parser = OptionParser()
-        parser.add_option("-n", "--now",
-            action="store_true", dest="run_now", default=False,
-            help="run nosetests immediately")
-        parser.add_option("-o", "--noseopts",
-            dest="noseopts", help="command to be run")
-
-        options, args = parser.parse_args()
-        return options
-
     def run(self):
         """Start notifier loop"""
         welcome = "Supcut %s. %d files monitored" % \
@@ -718,15 +1680,197 @@ send_osd_notifications in the configuration file"""
 
         while True:
             self.screen.handle_keypress()
-            self.screen.refresh()
+            self.screen.render()
+
+    def toggle_focus(self):
+        """Switch focus mode on or off"""
+        self.focus = not self.focus
+        log.append("%sfocus %s" % (self.tag, 'on' if self.focus else 'off'))
+        self.screen.refresh()
+        return self.focus
 
     def run_test_now(self):
-        Runner().run_nose(None)
+        """Run all the tests without waiting for the quiet period"""
+        self.scheduler.notify(None, delay=0)
+
+    def shutdown(self):
+        """Stop the runs, the workers and the servers of the project"""
+        self.scheduler.cancel()
+        self.runner.stop_warm()
+        self.runner.stop_bisect()
+        self.dispatcher.stop()
+        if self.server:
+            self.server.close()
+        if self.hashes:
+            self.hashes.save()
 
     def terminate(self):
         """Reset curses and exit
         """
         self.screen.terminate()
+        self.shutdown()
+        try:
+            self._notifier.stop()
+        except RuntimeError:
+            pass
+        except OSError:
+            pass
+
+        for log_line in log.buffer:
+            print log_line
+        for line in self.timings.format_summary():
+            print line
+        log.close()
+
+class SupervisorScreen(Screen):
+    """Combined status of the supervised projects, above the most recent
+    log lines"""
+
+    def _render(self, msg=None):
+        """Draw the screen"""
+        self._blank()
+        sup = self._supcut
+        max_y, max_x = self._screen.getmaxyx()
+        self.addstr(1, 2, 'Projects', bold=True)
+        self._cursor = 3
+        width = max(len(p.tag) for p in sup.projects)
+        running = waiting = failing = 0
+        for n, project in enumerate(sup.projects):
+            if project.currently_running.locked():
+                state = "running %d" % project.runner.progress()[0]
+                running += 1
+            elif project.scheduler.waiting:
+                state = "waiting"
+                waiting += 1
+            else:
+                state = "idle"
+            with project.lock:
+                counts = (project.total_tests_n, len(project.failing_tests),
+                    project.last_run, project.last_run_duration)
+            failing += counts[1]
+            tstamp = "--:--:--"
+            if counts[2]:
+                tstamp = strftime("%H:%M:%S", gmtime(counts[2]))
+            self._print("%-*s %-12s Tot: %5d Failed: %4d Last run: %s "
+                "Len: %s" % (width, project.tag.strip(), state, counts[0],
+                counts[1], tstamp, counts[3]), bold=(n == self._y))
+        self._cursor += 1
+        rows = max_y - 2 - self._cursor
+        for line in log.tail(max(rows, 0)):
+            self._print(line[:max_x - 4])
+
+        if msg is None:
+            msg = "%d projects, %d running, %d waiting, %d failing tests" % (
+                len(sup.projects), running, waiting, failing)
+        self._print_footer(msg)
+        self._flush()
+
+    def handle_keypress(self):
+        """Handle user input"""
+        c = self._screen.getch()
+        if c == -1:
+            # timeout
+            return
+        self.refresh()
+        projects = self._supcut.projects
+
+        # quit
+        if c == ord('q'):
+            raise KeyboardInterrupt
+
+        # select a project
+        elif c == curses.KEY_DOWN:
+            if self._y < len(projects) - 1:
+                self._y += 1
+        elif c == curses.KEY_UP:
+            if self._y:
+                self._y -= 1
+
+        # run the selected project now
+        elif c == ord('r'):
+            projects[self._y].run_test_now()
+
+        # run all the projects now
+        elif c == ord('a'):
+            for project in projects:
+                project.run_test_now()
+
+        # redraw screen
+        elif c == ord('d'):
+            self._size = None
+
+
+class Supervisor(object):
+    """Watch and test several projects from one process. The projects
+    share one inotify instance, and at most max_runs of them run their
+    tests at the same time, in the order they became ready.
+    """
+
+    def __init__(self, roots, cli_opts):
+        """Setup a Supcut for each project root"""
+        self.cli_opts = cli_opts
+        roots = [abspath(r) for r in roots]
+        if not roots:
+            say("No project root given")
+            exit(1)
+        for root in roots:
+            if not isfile(join(root, '.supcut', 'config.ini')):
+                say("The file %s is missing: run supcut in %s first." % (
+                    join(root, '.supcut', 'config.ini'), root))
+                exit(1)
+        if cli_opts.daemon:
+            # before starting any thread
+            daemonize()
+
+        self.limiter = Limiter(max(1, cli_opts.max_runs))
+        self._wm = pyinotify.WatchManager()
+        self._notifier = pyinotify.ThreadedNotifier(self._wm)
+
+        headless = cli_opts.headless or cli_opts.daemon
+        if headless:
+            self.screen = HeadlessScreen(echo=False)
+            signal(SIGTERM, lambda signum, frame: self.screen.stop())
+        else:
+            self.screen = SupervisorScreen(parent=self)
+
+        # projects are named after their directory, or their path when
+        # the names are ambiguous
+        names = [basename(r) for r in roots]
+        self.projects = []
+        for root, name in zip(roots, names):
+            if names.count(name) > 1:
+                name = root
+            self.projects.append(Supcut(root, cli_opts, wm=self._wm,
+                limiter=self.limiter, screen=None if headless else self.screen,
+                name=name))
+
+    def run(self):
+        """Start notifier loop"""
+        welcome = "Supcut %s. %d projects supervised" % (__version__,
+            len(self.projects))
+        self.screen.refresh(msg=welcome)
+
+        if self.cli_opts.run_now:
+            for project in self.projects:
+                project.run_test_now()
+
+        self._notifier.start()
+        log.append('starting file monitoring')
+
+        screens = [self.screen]
+        for project in self.projects:
+            if project.screen not in screens:
+                screens.append(project.screen)
+        while True:
+            self.screen.handle_keypress()
+            for screen in screens:
+                screen.render()
+
+    def terminate(self):
+        """Stop all the projects and exit"""
+        self.screen.terminate()
+        for project in self.projects:
+            project.shutdown()
         try:
             self._notifier.stop()
         except RuntimeError:
@@ -736,6 +1880,87 @@ send_osd_notifications in the configuration file"""
 
         for log_line in log.buffer:
             print log_line
+        log.close()
+
+def parse_args():
+    """Parse command-line args, returns (options, project roots)"""
+    parser = OptionParser(usage="%prog [options]\n"
+        "       %prog --supervise [options] root [root ...]")
+    parser.add_option("-n", "--now",
+        action="store_true", dest="run_now", default=False,
+        help="run nosetests immediately")
+    parser.add_option("-o", "--noseopts",
+        dest="noseopts", help="command to be run")
+    parser.add_option("--no-cache",
+        action="store_true", dest="no_cache", default=False,
+        help="run all the tests ignoring the cached results")
+    parser.add_option("--headless",
+        action="store_true", dest="headless", default=False,
+        help="print the results instead of using curses, and serve "
+        "them on .supcut/socket")
+    parser.add_option("--daemon",
+        action="store_true", dest="daemon", default=False,
+        help="run headless in the background")
+    parser.add_option("--supervise",
+        action="store_true", dest="supervise", default=False,
+        help="watch and test the projects in the given root directories")
+    parser.add_option("--max-runs", type="int",
+        dest="max_runs", default=cpu_count(),
+        help="maximum number of projects tested at the same time "
+        "when supervising [default: %default]")
+    parser.add_option("--runs",
+        action="store_true", dest="runs", default=False,
+        help="list the archived runs, or the ones where the --test "
+        "test failed, and exit")
+    parser.add_option("--show", type="int",
+        dest="show", metavar="RUN",
+        help="print the archived output of a run, or the trace of the "
+        "--test test, and exit")
+    parser.add_option("--test",
+        dest="test", metavar="NAME",
+        help="test name for --runs and --show")
+
+    return parser.parse_args()
+
+def show_archive(options):
+    """Print the archived runs or the output of one of them"""
+    path = join('.supcut', 'archive.db')
+    if not isfile(path):
+        say("No archive found in %s" % path)
+        exit(1)
+    archive = Archive(path)
+    if options.show is not None:
+        if options.test:
+            chunks = archive.trace(options.show, options.test)
+        else:
+            chunks = archive.read(options.show)
+        for chunk in chunks:
+            stdout.write(chunk)
+    elif options.test:
+        for run_id, started in archive.failures(options.test):
+            say("%6d  %s" % (run_id,
+                strftime("%Y-%m-%d %H:%M:%S", localtime(started))))
+    else:
+        for run_id, started, tot, failed, size in archive.runs():
+            say("%6d  %s  %5s tests  %4d failing  %8d bytes" % (run_id,
+                strftime("%Y-%m-%d %H:%M:%S", localtime(started)),
+                tot, failed, size))
+        runs, size, stored = archive.stats()
+        say("%d runs, %d bytes of output stored in %d bytes" % (runs,
+            size, stored))
+    archive.close()
+
+def daemonize():
+    """Detach from the terminal, keeping the working directory"""
+    if fork():
+        _exit(0)
+    setsid()
+    if fork():
+        _exit(0)
+    null = os_open('/dev/null', O_RDWR)
+    for fd in (0, 1, 2):
+        dup2(null, fd)
+    close(null)
 
 def main():
     global supcut
@@ -743,8 +1968,20 @@ def main():
     global log
     log = Log()
 
+    options, roots = parse_args()
+    if options.runs or options.show is not None:
+        show_archive(options)
+        return
     try:
-        supcut = Supcut()
+        if options.supervise:
+            supcut = Supervisor(roots, options)
+            # one log for all the projects, set up by the first one
+            project = supcut.projects[0]
+        else:
+            project = supcut = Supcut(cli_opts=options)
+        conf = project.conf
+        log.setup(conf.log_size, conf.log_file and join(project.root,
+            conf.log_file), conf.log_file_size, conf.log_backups)
         supcut.run()
     except KeyboardInterrupt:
         if supcut:
@@ -0,0 +1,141 @@
+#
+# supcut - Simple Unobtrusive Python Contituous Unit Testing
+#
+# Copyright (C) 2010 Federico Ceratto
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import deque
+from contextlib import contextmanager
+import json
+from os.path import isfile
+from threading import Lock
+from time import time
+
+# pipeline stages, in order
+STAGES = ('event', 'debounce', 'spawn', 'tests', 'parse', 'ingest',
+    'merge', 'diff', 'history', 'archive', 'osd', 'email')
+
+
+class RunTimings(object):
+    """Timing spans of the stages of a run, from the first file change to
+    the last notification. Spans of the same stage can overlap, e.g. when
+    running shards in parallel; the time spent parsing the streamed output
+    is accumulated instead.
+    """
+
+    def __init__(self, run_id, started):
+        self.run_id = run_id
+        self.started = started
+        self.spans = []     # (stage, start, end, tid)
+        self.totals = {}    # stage -> accumulated seconds
+        self._lock = Lock()
+
+    def add(self, stage, start, end=None, tid=0):
+        """Add a span, ending now by default"""
+        if end is None:
+            end = time()
+        with self._lock:
+            self.spans.append((stage, start, end, tid))
+
+    def accumulate(self, stage, seconds):
+        """Add time to an accumulated stage"""
+        with self._lock:
+            self.totals[stage] = self.totals.get(stage, 0) + seconds
+
+    @contextmanager
+    def span(self, stage, tid=0):
+        """Time a block of code"""
+        start = time()
+        try:
+            yield
+        finally:
+            self.add(stage, start, tid=tid)
+
+    def stages(self):
+        """Return the wall clock time of each stage"""
+        bounds = {}
+        for stage, start, end, tid in self.spans:
+            lo, hi = bounds.get(stage, (start, end))
+            bounds[stage] = (min(lo, start), max(hi, end))
+        d = dict((stage, hi - lo) for stage, (lo, hi) in bounds.iteritems())
+        d.update(self.totals)
+        return d
+
+    def format(self):
+        """One line description"""
+        d = self.stages()
+        return ' '.join("%s %.3fs" % (stage, d[stage])
+            for stage in STAGES if stage in d)
+
+
+class Timings(object):
+    """Keep the timings of the recent runs, optionally exported as JSON
+    lines and in the Chrome trace event format"""
+
+    def __init__(self, keep=100, jsonl_path=None, trace_path=None):
+        self._runs = deque(maxlen=keep)
+        self._jsonl_path = jsonl_path
+        self._trace_path = trace_path
+        self._run_id = 0
+        self._lock = Lock()
+
+    def start(self, started=None):
+        """Start timing a new run"""
+        with self._lock:
+            self._run_id += 1
+            return RunTimings(self._run_id, started or time())
+
+    def finish(self, run):
+        """Store and export the timings of a run"""
+        with self._lock:
+            self._runs.append(run)
+        if self._jsonl_path:
+            f = open(self._jsonl_path, 'a')
+            f.write(json.dumps(dict(run=run.run_id, started=run.started,
+                stages=run.stages(), spans=run.spans)) + '\n')
+            f.close()
+        if self._trace_path:
+            new = not isfile(self._trace_path)
+            f = open(self._trace_path, 'a')
+            if new:
+                # the closing bracket can be omitted
+                f.write('[\n')
+            for stage, start, end, tid in run.spans:
+                f.write(json.dumps(dict(name=stage, ph='X', pid=1, tid=tid,
+                    ts=int(start * 1e6), dur=int((end - start) * 1e6),
+                    args=dict(run=run.run_id))) + ',\n')
+            f.close()
+
+    def summary(self):
+        """Return (stage, p50, p95, runs) tuples over the recent runs"""
+        with self._lock:
+            runs = list(self._runs)
+        per_stage = {}
+        for run in runs:
+            for stage, seconds in run.stages().iteritems():
+                per_stage.setdefault(stage, []).append(seconds)
+        out = []
+        for stage in STAGES:
+            values = sorted(per_stage.get(stage, ()))
+            if values:
+                out.append((stage, values[len(values) / 2],
+                    values[min(len(values) - 1, int(len(values) * .95))],
+                    len(values)))
+        return out
+
+    def format_summary(self):
+        """Describe the summary, one line per stage"""
+        return ["%-8s p50 %.3fs p95 %.3fs (%d runs)" % row
+            for row in self.summary()]
@@ -0,0 +1,124 @@
+#
+# supcut - Simple Unobtrusive Python Contituous Unit Testing
+#
+# Copyright (C) 2010 Federico Ceratto
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+from os.path import abspath, splitext
+from subprocess import Popen, PIPE
+import sys
+
+
+class WarmWorker(object):
+    """Handle a warm worker: a long lived interpreter having nose and the
+    third party modules already imported. Every run is executed by a child
+    forked from the worker, importing the project modules from scratch.
+
+    The worker reads JSON requests on stdin and writes JSON replies on
+    stdout; the output of the tests goes to a named pipe.
+    """
+
+    def __init__(self, preload=(), cwd=None):
+        script = abspath(splitext(__file__)[0] + '.py')
+        self._p = Popen([sys.executable, script] + list(preload),
+            stdin=PIPE, stdout=PIPE, close_fds=True, cwd=cwd)
+
+    def _reply(self):
+        """Read a reply from the worker"""
+        line = self._p.stdout.readline()
+        if not line:
+            raise IOError("warm worker %d died" % self._p.pid)
+        return json.loads(line)
+
+    def start(self, argv, fifo):
+        """Start nose with argv, writing its output in the fifo, which
+        must be open for reading already. Returns the pid of the process
+        running the tests, which is the leader of a new process group.
+        """
+        self._p.stdin.write(json.dumps(dict(argv=argv, fifo=fifo)) + '\n')
+        self._p.stdin.flush()
+        return self._reply()['pid']
+
+    def wait(self):
+        """Wait for the run to end, returns its exit status, CPU time and
+        peak RSS in KB"""
+        reply = self._reply()
+        return reply['status'], reply['cpu'], reply['max_rss']
+
+    def stop(self):
+        """Terminate the worker"""
+        try:
+            self._p.stdin.close()
+            self._p.wait()
+        except (IOError, OSError):
+            pass
+
+
+def _child(argv, fd):
+    """Run nose in the forked child writing on fd, never returns"""
+    code = 1
+    try:
+        os.setsid()
+        os.dup2(fd, 1)
+        os.dup2(fd, 2)
+        os.close(fd)
+        null = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(null, 0)
+        os.close(null)
+        import nose
+        nose.main(argv=argv)
+    except SystemExit, e:
+        code = int(bool(e.code))
+    except:
+        import traceback
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+
+
+def serve(preload):
+    """Preload the modules and serve requests from stdin"""
+    for name in preload:
+        try:
+            __import__(name)
+        except Exception, e:
+            sys.stderr.write("unable to preload %s: %s\n" % (name, e))
+    reply = sys.stdout
+    for line in iter(sys.stdin.readline, ''):
+        req = json.loads(line)
+        # the reader has opened the fifo already
+        fd = os.open(req['fifo'], os.O_WRONLY)
+        pid = os.fork()
+        if pid == 0:
+            _child(req['argv'], fd)
+        os.close(fd)
+        reply.write(json.dumps(dict(pid=pid)) + '\n')
+        reply.flush()
+        pid, status, usage = os.wait4(pid, 0)
+        reply.write(json.dumps(dict(status=status,
+            cpu=usage.ru_utime + usage.ru_stime,
+            max_rss=usage.ru_maxrss)) + '\n')
+        reply.flush()
+
+
+if __name__ == '__main__':
+    # do not shadow the project modules with the supcut ones
+    del sys.path[0]
+    sys.path.insert(0, os.getcwd())
+    serve(sys.argv[1:])
@@ -0,0 +1,65 @@
+#
+# supcut - Simple Unobtrusive Python Contituous Unit Testing
+#
+# Copyright (C) 2010 Federico Ceratto
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from xml.etree.cElementTree import iterparse
+
+from noseoutput import RunResult
+
+# xunit element -> test status
+STATUSES = {
+    'failure': 'fail',
+    'error': 'error',
+    'skipped': 'skip',
+}
+
+
+def parse_xunit(path, max_trace_lines=1000):
+    """Parse a file generated by nosetests --with-xunit, one testcase
+    element at a time. Returns a RunResult having the status and duration
+    of every test.
+    Raises IOError or SyntaxError if the file is missing or broken.
+    """
+    result = RunResult()
+    result.tot = 0
+    result.run_time = 0.0
+    for event, elem in iterparse(path):
+        if elem.tag == 'testcase':
+            name = "%s.%s" % (elem.get('classname'), elem.get('name'))
+            duration = float(elem.get('time') or 0)
+            status = 'pass'
+            for child in elem:
+                if child.tag in STATUSES:
+                    status = STATUSES[child.tag]
+                    if status != 'skip':
+                        trace = (child.text or '').splitlines()
+                        if len(trace) > max_trace_lines:
+                            omitted = len(trace) - max_trace_lines
+                            trace = trace[:max_trace_lines]
+                            trace.append("[%d lines omitted]" % omitted)
+                        result.failing[name] = trace
+            result.tests[name] = (status, duration)
+            result.tot += 1
+            result.run_time += duration
+            elem.clear()
+        elif elem.tag == 'testsuite':
+            for k, key in (('failures', 'failures'), ('errors', 'errors'),
+                    ('skip', 'SKIP')):
+                n = int(elem.get(k) or 0)
+                if n:
+                    result.counts[key] = n
+    return result